@@ -0,0 +1,10 @@
+"""
+persona 分析各週腳本共用的模組：model client、問卷讀取、checkpoint、排程、persona 驗證與輸出、
+對話紀錄、問卷的共用處理流程與背景 job。各腳本只保留自己的 prompt、輸出格式與介面。
+"""
+import os
+
+# 快取目錄：各腳本載入前以 PERSONA_CACHE_DIR 指定為腳本所在位置的 .persona_cache，未指定時放在專案根目錄
+CACHE_DIR = os.environ.get("PERSONA_CACHE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".persona_cache"
+)
@@ -0,0 +1,73 @@
+"""
+checkpoint 日誌（中斷後續跑）與增量模式的批次指紋紀錄。
+"""
+import os
+import json
+import hashlib
+
+from . import CACHE_DIR
+
+# checkpoint 日誌的存放位置，每份輸入一個 append-only 的 JSON Lines 檔
+JOURNAL_DIR = os.path.join(CACHE_DIR, "journal")
+
+def load_journal(input_hash):
+    """
+    讀取 checkpoint 日誌，回傳 {批次編號: (messages, personas)}。
+    中斷時寫到一半的最後一行會被略過，該批次會重新處理。
+    """
+    path = os.path.join(JOURNAL_DIR, f"{input_hash}.jsonl")
+    finished = {}
+    if not os.path.exists(path):
+        return finished
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry.get("input_hash") == input_hash:
+                finished[entry["chunk"]] = (entry["messages"], entry["personas"])
+    return finished
+
+def append_journal(input_hash, chunk_idx, messages, personas):
+    """批次完成後立即在日誌追加一行並 fsync，程式中斷也不會遺失已完成的批次"""
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    path = os.path.join(JOURNAL_DIR, f"{input_hash}.jsonl")
+    line = json.dumps(
+        {"input_hash": input_hash, "chunk": chunk_idx, "messages": messages, "personas": personas},
+        ensure_ascii=False, default=str,
+    )
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def clear_journal(input_hash):
+    """不續跑時刪除舊的 checkpoint 日誌，從頭開始"""
+    path = os.path.join(JOURNAL_DIR, f"{input_hash}.jsonl")
+    if os.path.exists(path):
+        os.remove(path)
+
+# 增量模式的紀錄位置：每份問卷記錄各批次的指紋與產生的 persona
+INCREMENTAL_DIR = os.path.join(CACHE_DIR, "incremental")
+
+def chunk_fingerprint(chunk):
+    """以批次內容計算指紋，內容沒有變動的批次不必重新處理"""
+    return hashlib.sha256(chunk.to_csv(index=False).encode("utf-8")).hexdigest()
+
+def load_manifest(survey_key):
+    """讀取上次增量執行的紀錄，格式為 {批次編號: {"fingerprint", "personas"}}"""
+    path = os.path.join(INCREMENTAL_DIR, f"{survey_key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(survey_key, manifest):
+    """先寫入暫存檔再取代原檔，避免中斷時留下不完整的紀錄"""
+    os.makedirs(INCREMENTAL_DIR, exist_ok=True)
+    path = os.path.join(INCREMENTAL_DIR, f"{survey_key}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, default=str)
+    os.replace(path + ".tmp", path)
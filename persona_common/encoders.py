@@ -0,0 +1,58 @@
+"""
+問卷批次資料送進 prompt 前的序列化方式。
+"""
+from .llm import estimate_tokens
+
+def encode_records(chunk):
+    """原本的格式：逐列的 dict，每一列都會重複完整的題目"""
+    return str(chunk.to_dict(orient='records'))
+
+def _compact_columns(chunk):
+    """去掉整欄皆為空值的欄位，並以 c1, c2... 短代號取代題目"""
+    chunk = chunk.dropna(axis=1, how="all")
+    codes = [f"c{i}" for i in range(1, chunk.shape[1] + 1)]
+    legend = "\n".join(f"{code}={name}" for code, name in zip(codes, chunk.columns))
+    return chunk, codes, legend
+
+def encode_tsv(chunk):
+    """題目只列一次的 TSV 格式"""
+    chunk, codes, legend = _compact_columns(chunk)
+    body = chunk.to_csv(sep="\t", index=False, header=codes)
+    return f"欄位說明:\n{legend}\n資料(TSV):\n{body}"
+
+def encode_coded(chunk):
+    """TSV 格式，並把重複出現的答案換成代碼，附上代碼表"""
+    chunk, codes, legend = _compact_columns(chunk)
+    chunk = chunk.copy()
+    code_tables = []
+    for code, name in zip(codes, chunk.columns):
+        counts = chunk[name].value_counts()
+        # 只有重複出現、且本身比代碼佔更多 token 的答案換成代碼才划算
+        repeated = [value for value, n in counts.items() if n > 1 and estimate_tokens(str(value)) > 2]
+        if not repeated:
+            continue
+        mapping = {value: f"{code}.{i}" for i, value in enumerate(repeated, start=1)}
+        chunk[name] = chunk[name].map(lambda v: mapping.get(v, v))
+        code_tables.append(f"{code}: " + " | ".join(f"{c}={v}" for v, c in mapping.items()))
+    body = chunk.to_csv(sep="\t", index=False, header=codes)
+    return f"欄位說明:\n{legend}\n答案代碼表:\n" + "\n".join(code_tables) + f"\n資料(TSV):\n{body}"
+
+# 可替換的批次資料序列化方式
+CHUNK_ENCODERS = {
+    "records": encode_records,
+    "tsv": encode_tsv,
+    "coded": encode_coded,
+}
+DEFAULT_CHUNK_ENCODER = "coded"
+
+def encode_chunk(chunk, encoder=DEFAULT_CHUNK_ENCODER):
+    """依指定方式序列化批次資料，並回報相對於原本 dict 格式省下的 token 數"""
+    text = CHUNK_ENCODERS[encoder](chunk)
+    encoded_tokens = estimate_tokens(text)
+    baseline_tokens = encoded_tokens if encoder == "records" else estimate_tokens(encode_records(chunk))
+    return text, {
+        "encoder": encoder,
+        "baseline_tokens": baseline_tokens,
+        "encoded_tokens": encoded_tokens,
+        "tokens_saved": baseline_tokens - encoded_tokens,
+    }
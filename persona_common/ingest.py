@@ -0,0 +1,211 @@
+"""
+問卷 CSV 的讀取：記憶體映射、一次掃描取得編碼、輸入雜湊與筆數（scan_csv），以及逐批解碼與解析。
+"""
+import os
+import io
+import csv
+import json
+import codecs
+import hashlib
+import mmap
+import contextlib
+
+import chardet
+import pandas as pd
+
+from . import CACHE_DIR
+
+@contextlib.contextmanager
+def map_file(path):
+    """以唯讀記憶體映射開啟檔案，不把內容讀進 Python 的緩衝區；空檔案無法映射，改為回傳空的 bytes"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+# 編碼偵測：先以候選編碼快速驗證整份檔案，都不通過才以 chardet 對開頭取樣，從候選編碼中挑選最可能的一個；
+# chardet 的結果不在候選編碼內時（例如 cp875、IBM866 這類會把中文解成亂碼的單位元組編碼）改用 utf-8
+ENCODING_CANDIDATES = ("utf-8-sig", "utf-8", "cp950", "big5")
+ENCODING_SAMPLE_BYTES = 10000
+ENCODING_VALIDATE_BLOCK = 4 * 1024 * 1024  # 增量解碼每次處理的位元組數
+# 偵測結果依檔案內容的雜湊快取，相同的檔案再次上傳時不必重新偵測
+ENCODING_CACHE_PATH = os.path.join(CACHE_DIR, "encoding.json")
+
+def validate_encoding(data, encoding):
+    """以增量解碼器分段驗證整份內容能否以 encoding 解碼，不必一次解碼成完整字串"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        for start in range(0, len(data), ENCODING_VALIDATE_BLOCK):
+            decoder.decode(data[start:start + ENCODING_VALIDATE_BLOCK])
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def is_candidate_encoding(encoding):
+    """判斷編碼名稱（可能是別名，例如 chardet 回傳的 Big5、UTF-8-SIG）是否為候選編碼之一"""
+    if not encoding:
+        return False
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return False
+    return name in {codecs.lookup(candidate).name for candidate in ENCODING_CANDIDATES}
+
+def load_encoding_cache():
+    try:
+        with open(ENCODING_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_encoding_cache(cache):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(ENCODING_CACHE_PATH + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(ENCODING_CACHE_PATH + ".tmp", ENCODING_CACHE_PATH)
+
+def guess_encoding(data):
+    """候選編碼都無法完整解碼時，以 chardet 對開頭取樣推測；結果不在候選編碼內就改用 utf-8"""
+    guess = chardet.detect(data[:ENCODING_SAMPLE_BYTES])["encoding"]
+    encoding = guess if is_candidate_encoding(guess) else "utf-8"
+    print(f"候選編碼皆無法完整解碼，chardet 偵測為 {guess}，以 {encoding} 為主逐批解碼")
+    return encoding
+
+def remember_encoding(cache, file_hash, encoding):
+    cache[file_hash] = encoding
+    try:
+        save_encoding_cache(cache)
+    except OSError as e:
+        print(f"無法寫入編碼快取: {e}")
+
+# 問卷的開放式回答可能很長，放寬 csv 模組預設的欄位長度上限（131072 字元）
+csv.field_size_limit(2 ** 31 - 1)
+
+def iter_record_ends(data, start=0):
+    """
+    從 start 起以 csv 模組逐筆解析，產生每筆紀錄（空白列不計）結束處的位元組位置。
+    以 latin-1 逐位元組對應解碼，分隔符號、引號與換行都是 ASCII，UTF-8 與 Big5 的多位元組字元不會被誤判；
+    欄位中間的單一引號依 CSV 規則視為一般字元，與 pandas 的解析結果一致。
+    """
+    position = start
+
+    def lines():
+        nonlocal position
+        while position < len(data):
+            end = data.find(b"\n", position)
+            end = len(data) if end == -1 else end + 1
+            line = data[position:end]
+            position = end
+            yield line.decode("latin-1")
+
+    # csv.reader 只在需要時讀取下一行，每產生一筆紀錄時 position 正好停在該筆的結尾
+    for record in csv.reader(lines()):
+        if len(record) > 1 or (record and record[0].strip()):
+            yield position
+
+def row_byte_offset(data, rows, start=0):
+    """回傳從 start 起略過 rows 筆紀錄（引號內的換行不算新的一列，空白列不計）後的位元組位置"""
+    if rows <= 0:
+        return start
+    for count, end in enumerate(iter_record_ends(data, start), start=1):
+        if count == rows:
+            return end
+    return len(data)
+
+def decode_block(block, encoding, split_lines=True):
+    """
+    以偵測到的編碼解碼一段內容，失敗時改試其他候選編碼，回傳 (文字, 使用的編碼)。
+    整段都無法以單一編碼解碼時（編碼在段落中間切換），改為逐行解碼；單行仍失敗才以替代字元取代。
+    """
+    for candidate in (encoding, *ENCODING_CANDIDATES):
+        try:
+            return block.decode(candidate), candidate
+        except UnicodeDecodeError:
+            continue
+    if split_lines:
+        # 換行字元不會出現在 UTF-8 或 Big5 多位元組字元的中間，可安全地依行切開
+        lines = [decode_block(line, encoding, split_lines=False)[0] for line in block.split(b"\n")]
+        return "\n".join(lines), "各行分別判斷的編碼"
+    return block.decode(encoding, errors="replace"), f"{encoding}（以替代字元取代無法解碼的位元組）"
+
+def read_csv_chunks(csv_path, encoding, columns, chunksize=1000):
+    """
+    惰性逐批讀取 CSV：在記憶體映射上依列切出每一批的位元組，解碼後交給 pandas 解析。
+    某一批無法以偵測到的編碼解碼時（例如混合 Big5 與 UTF-8 的匯出檔），只重新解碼該批，
+    不必從頭重讀，下一批仍先以原本的編碼解碼。
+    columns 為標題列的欄位名稱，各批共用。
+    """
+    consumed = 0
+    with map_file(csv_path) as data:
+        start = row_byte_offset(data, 1)
+        while start < len(data):
+            end = row_byte_offset(data, chunksize, start)
+            block = data[start:end]
+            start = end
+            if not block.strip():
+                continue
+            text, used = decode_block(block, encoding)
+            if used != encoding:
+                print(f"第 {consumed} 筆起的一批資料無法以 {encoding} 解碼，改以 {used} 解碼")
+            chunk = pd.read_csv(io.StringIO(text), header=None, names=list(columns))
+            chunk.index = range(consumed, consumed + len(chunk))
+            consumed += len(chunk)
+            yield chunk
+
+def count_lines(lines, rows=0, in_quotes=False):
+    """
+    依每行引號數的奇偶計算資料列數（含標題列），引號內的換行不算新的一列，空白列不計。
+    回傳 (列數, 結尾是否仍在引號內)，可分段呼叫累計。
+    """
+    for line in lines:
+        if line.count(b'"') % 2:
+            in_quotes = not in_quotes
+        if not in_quotes and line.strip():
+            rows += 1
+    return rows, in_quotes
+
+def scan_csv(csv_path, md_content=()):
+    """
+    一次掃描 CSV 取得輸入雜湊、檔案的 blake2b 雜湊與資料筆數，再決定編碼，回傳 (encoding, input_hash, rows)。
+    input_hash 涵蓋 CSV 與訪談內容，作為 checkpoint 日誌的鍵。
+    筆數依每行引號數的奇偶計算，引號內的換行不算新的一列；掃描到檔尾引號仍未閉合時
+    （例如欄位中間有單一引號），改以 csv 模組實際解析計算。
+    編碼先查 encoding.json 中以 blake2b 雜湊快取的結果，相同的檔案再次上傳時不必重新解碼驗證；
+    未命中時依序以候選編碼驗證整份檔案（有 BOM 時先驗證 utf-8-sig），第一個通過的即為結果並寫入快取。
+    全部不通過（例如混合編碼的匯出檔）才以 chardet 取樣推測，推測結果不快取，交給逐批重新解碼處理。
+    """
+    input_hash = hashlib.sha256()
+    file_hash = hashlib.blake2b(digest_size=16)
+    rows, in_quotes = 0, False
+    tail = b""
+    with map_file(csv_path) as data:
+        for start in range(0, len(data), ENCODING_VALIDATE_BLOCK):
+            block = data[start:start + ENCODING_VALIDATE_BLOCK]
+            input_hash.update(block)
+            file_hash.update(block)
+            # 跨段落的最後一行留到下一段再計算
+            lines = (tail + block).split(b"\n")
+            tail = lines.pop()
+            rows, in_quotes = count_lines(lines, rows, in_quotes)
+        rows, in_quotes = count_lines([tail], rows, in_quotes)
+        if in_quotes:
+            print("CSV 的引號數無法配對，改以 csv 模組解析計算筆數")
+            rows = sum(1 for _ in iter_record_ends(data))
+
+        cache = load_encoding_cache()
+        encoding = cache.get(file_hash.hexdigest())
+        if encoding is not None:
+            print(f"沿用快取的 CSV 編碼偵測結果: {encoding}")
+        else:
+            candidates = ENCODING_CANDIDATES if data[:3] == codecs.BOM_UTF8 else ENCODING_CANDIDATES[1:]
+            encoding = next((enc for enc in candidates if validate_encoding(data, enc)), None)
+            if encoding is None:
+                encoding = guess_encoding(data)
+            else:
+                remember_encoding(cache, file_hash.hexdigest(), encoding)
+    for content in md_content:
+        input_hash.update(content.encode("utf-8"))
+    return encoding, input_hash.hexdigest(), max(rows - 1, 0)
@@ -0,0 +1,105 @@
+"""
+各批次共用的背景資料：訪談摘要與外部學習資源的搜尋結果，兩者都快取在磁碟。
+"""
+import os
+import json
+import time
+import hashlib
+
+from autogen_core.models import SystemMessage, UserMessage
+
+from . import CACHE_DIR
+
+async def read_md_files_from_paths(file_paths):
+    """讀取多個 .md 檔案，返回內容列表"""
+    md_content = []
+    for file_path in file_paths:
+        print(f"正在讀取 {file_path} ...")
+        with open(file_path, "r", encoding="utf-8") as file:
+            content = file.read()
+            md_content.append(content)
+    print(f"總共讀取到 {len(md_content)} 個 MD 檔案")
+    return md_content
+
+_interview_digests = {}
+
+async def build_interview_digest(md_content, model_client):
+    """
+    將所有訪談內容濃縮成一份摘要，每次執行只產生一次並在各批次間共用。
+    以訪談內容的雜湊值作為快取鍵，同時快取在記憶體與磁碟。
+    """
+    joined = "\n".join(md_content)
+    if not joined.strip():
+        return ""
+    digest_key = hashlib.sha256(joined.encode("utf-8")).hexdigest()
+    if digest_key in _interview_digests:
+        return _interview_digests[digest_key]
+
+    cache_path = os.path.join(CACHE_DIR, "interview_digest", f"{digest_key}.md")
+    if os.path.exists(cache_path):
+        print(f"使用快取的訪談摘要: {cache_path}")
+        with open(cache_path, "r", encoding="utf-8") as f:
+            digest = f.read()
+    else:
+        print("正在產生訪談摘要 ...")
+        response = await model_client.create([
+            SystemMessage(content="你是使用者研究員，負責整理課程受眾的訪談紀錄。"),
+            UserMessage(
+                content=(
+                    "請將以下訪談紀錄濃縮成條列式摘要，保留每位受訪者的背景、學習動機、學習目標、"
+                    "遇到的困難、偏好的學習方式與關鍵原話，並保留受訪者之間的差異：\n\n" + joined
+                ),
+                source="user",
+            ),
+        ])
+        digest = response.content
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            f.write(digest)
+    print(f"訪談摘要長度: {len(digest)} 字（原始訪談 {len(joined)} 字）")
+    _interview_digests[digest_key] = digest
+    return digest
+
+# 外部學習資源的搜尋主題與快取有效時間（秒）
+RESEARCH_TOPIC = "最新的泰文學習建議的學習資源"
+RESEARCH_TTL_SECONDS = 7 * 24 * 60 * 60
+
+async def research_learning_resources(model_client, topic=RESEARCH_TOPIC, ttl=RESEARCH_TTL_SECONDS):
+    """
+    每個主題只請 MultimodalWebSurfer 搜尋一次，結果連同搜尋時間存在磁碟，
+    在有效時間內直接重用，並作為背景資料提供給所有批次；快取有效時不會開啟任何瀏覽器。
+    """
+    topic_key = hashlib.sha256(topic.encode("utf-8")).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, "research", f"{topic_key}.json")
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if time.time() - cached["fetched_at"] < ttl:
+            print(f"使用快取的外部資源搜尋結果: {topic}")
+            return cached["content"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    print(f"正在搜尋外部資源: {topic}")
+    # web surfer 需要 playwright，只有實際搜尋時才載入
+    from autogen_ext.agents.web_surfer import MultimodalWebSurfer
+    web_surfer = MultimodalWebSurfer("web_surfer", model_client)
+    try:
+        result = await web_surfer.run(task=f"請搜尋外部網站，整理{topic}，列出每個資源的名稱、網址與簡短說明。")
+    finally:
+        await web_surfer.close()
+    # web surfer 的回覆可能夾帶截圖，只保留文字部分
+    texts = []
+    for message in result.messages:
+        if message.source != "web_surfer":
+            continue
+        if isinstance(message.content, str):
+            texts.append(message.content)
+        elif isinstance(message.content, list):
+            texts.extend(part for part in message.content if isinstance(part, str))
+    content = "\n".join(texts)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump({"topic": topic, "fetched_at": time.time(), "content": content}, f, ensure_ascii=False)
+    return content
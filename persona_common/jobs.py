@@ -0,0 +1,227 @@
+"""
+Gradio 介面的背景 job：常駐 event loop 上的 job 佇列、進度事件與介面顯示。
+"""
+import os
+import asyncio
+import collections
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+# 背景工作：每次上傳建立一個 job，在常駐的 event loop 上執行，Gradio 只負責送出與查詢進度
+JOB_WORKERS = int(os.environ.get("PERSONA_JOB_WORKERS", "2"))  # 同時執行的 job 數
+JOB_POLL_SECONDS = 1  # 介面更新進度的間隔
+JOB_RETENTION_SECONDS = 24 * 60 * 60  # 完成超過此時間的 job 連同輸出目錄一併清除
+JOB_STATUS_LABELS = {"queued": "排隊中", "running": "執行中", "done": "完成", "failed": "失敗"}
+JOB_PREVIEW_PERSONAS = 200  # 每個 job 保留最近幾個 persona 供介面即時顯示
+JOB_PREVIEW_COLUMNS = ["batch_start", "persona_id", "description", "motivation"]
+JOB_PARTIAL_ZIP = "personas_partial.zip"  # pipeline 在 job 目錄中定期更新的部分結果，執行中即可下載
+
+async def stream_pipeline(run, *args, **kwargs):
+    """
+    以 async generator 執行 run（process_all），run 透過 on_event 回報的事件邊執行邊產生：
+    {"type": "progress", "done", "total"}、{"type": "persona", "batch_start", "persona"}、
+    {"type": "usage", "batch_start", "prompt_tokens", "completion_tokens"}，
+    結束時產生 {"type": "done", "outputs": run 的回傳值}；run 拋出的例外會直接傳出。
+    """
+    events = asyncio.Queue()
+    task = asyncio.create_task(run(*args, on_event=events.put_nowait, **kwargs))
+    try:
+        while not task.done() or not events.empty():
+            getter = asyncio.ensure_future(events.get())
+            await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+        yield {"type": "done", "outputs": task.result()}
+    finally:
+        if not task.done():
+            task.cancel()
+
+class JobManager:
+    """
+    背景 job 佇列：在獨立執行緒上維持一個常駐的 event loop，所有 job 都在這個 loop 上執行，
+    同時執行的數量由 semaphore 限制，超過的 job 排隊等待。
+    每個 job 有自己的輸出目錄，不切換工作目錄，多位使用者同時上傳也不會互相干擾。
+    """
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.jobs = {}
+        self._workers = workers
+        self._slots = None
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="persona-jobs", daemon=True).start()
+
+    def create(self):
+        """建立新的 job 與其輸出目錄；無法就地讀取的上傳內容也寫入此目錄"""
+        self._cleanup()
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "dir": tempfile.mkdtemp(prefix=f"persona_job_{job_id}_"),
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "done_chunks": 0,
+            "total_chunks": None,
+            "initial_done": None,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "personas": collections.deque(maxlen=JOB_PREVIEW_PERSONAS),
+            "persona_count": 0,  # 已產生的 persona 總數；personas 只保留最近 JOB_PREVIEW_PERSONAS 個
+            "outputs": None,
+            "error": None,
+        }
+        with self._lock:
+            self.jobs[job_id] = job
+        return job
+
+    def start(self, job, run, *args):
+        """將 run(*args, output_dir=..., on_event=...) 排入背景執行，立即返回"""
+        asyncio.run_coroutine_threadsafe(self._run(job, run, args), self._loop)
+
+    def get(self, job_id):
+        """
+        回傳 job 目前狀態的快照，找不到時回傳 None。
+        job 在背景執行緒上持續更新，介面的執行緒只讀取在 lock 內複製的快照，不直接走訪執行中的 deque。
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job, personas=list(job["personas"]))
+
+    async def _run(self, job, run, args):
+        # semaphore 須在 loop 所在的執行緒上建立
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._workers)
+        async with self._slots:
+            job["status"] = "running"
+            job["started"] = time.time()
+            try:
+                async for event in stream_pipeline(run, *args, output_dir=job["dir"]):
+                    with self._lock:
+                        self._apply(job, event)
+                if job["outputs"][0] is None:
+                    job["status"] = "failed"
+                    job["error"] = "無法讀取輸入檔案"
+                else:
+                    job["status"] = "done"
+            except Exception as e:
+                job["status"] = "failed"
+                job["error"] = f"{type(e).__name__}: {e}"
+                print(f"job {job['id']} 執行失敗: {job['error']}")
+            finally:
+                job["finished"] = time.time()
+
+    @staticmethod
+    def _apply(job, event):
+        """依 pipeline 產生的事件更新 job 狀態，呼叫端須持有 lock"""
+        if event["type"] == "progress":
+            if job["initial_done"] is None:
+                job["initial_done"] = event["done"]
+            job["done_chunks"], job["total_chunks"] = event["done"], event["total"]
+        elif event["type"] == "persona":
+            job["personas"].append(dict(event["persona"], batch_start=event["batch_start"]))
+            job["persona_count"] += 1
+        elif event["type"] == "usage":
+            job["prompt_tokens"] += event["prompt_tokens"] or 0
+            job["completion_tokens"] += event["completion_tokens"] or 0
+        elif event["type"] == "done":
+            job["outputs"] = event["outputs"]
+
+    def _cleanup(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        with self._lock:
+            expired = [job for job in self.jobs.values() if job["finished"] and job["finished"] < cutoff]
+            for job in expired:
+                del self.jobs[job["id"]]
+        for job in expired:
+            shutil.rmtree(job["dir"], ignore_errors=True)
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """取得共用的 JobManager；第一次送出或查詢 job 時才建立，載入模組時不會啟動背景執行緒"""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager()
+        return _job_manager
+
+def estimate_job_eta(job):
+    """以本次執行已完成批次的平均耗時估計剩餘秒數，無法估計時回傳 None"""
+    processed = job["done_chunks"] - (job["initial_done"] or 0)
+    if job["status"] != "running" or not job["total_chunks"] or processed <= 0:
+        return None
+    return (time.time() - job["started"]) / processed * (job["total_chunks"] - job["done_chunks"])
+
+def format_job_status(job):
+    """將 job 狀態整理成顯示在介面上的文字"""
+    text = f"job `{job['id']}`：{JOB_STATUS_LABELS[job['status']]}"
+    if job["total_chunks"]:
+        text += f"，已完成 {job['done_chunks']}/{job['total_chunks']} 個批次"
+    if job["started"]:
+        text += f"，經過 {(job['finished'] or time.time()) - job['started']:.0f} 秒"
+    eta = estimate_job_eta(job)
+    if eta is not None:
+        text += f"，預估剩餘 {eta:.0f} 秒"
+    if job["prompt_tokens"] or job["completion_tokens"]:
+        text += f"，tokens {job['prompt_tokens']}/{job['completion_tokens']}"
+    if job["persona_count"]:
+        text += f"，已產生 {job['persona_count']} 個 persona"
+    if job["error"]:
+        text += f"\n\n錯誤：{job['error']}"
+    return text
+
+def upload_path(file, job_dir, name):
+    """
+    取得上傳檔案的路徑：Gradio 上傳的暫存檔直接就地讀取，不複製到 job 目錄；
+    只有沒有實體檔案的內容（file-like 物件或 bytes）才以串流方式寫入 job 目錄。
+    """
+    if isinstance(file, str):
+        return file
+    if isinstance(getattr(file, "name", None), str) and os.path.isfile(file.name):
+        return file.name
+    path = os.path.join(job_dir, name)
+    with open(path, "wb") as f:
+        if hasattr(file, "read"):
+            shutil.copyfileobj(file, f)
+        else:
+            f.write(file)
+    return path
+
+def persona_preview(job):
+    """整理目前已產生的 persona（最近 JOB_PREVIEW_PERSONAS 個），供介面即時顯示；job 須為 JobManager.get 取得的快照"""
+    rows = [{column: persona.get(column, "") for column in JOB_PREVIEW_COLUMNS} for persona in job["personas"]]
+    return pd.DataFrame(rows, columns=JOB_PREVIEW_COLUMNS)
+
+async def watch_job(job_id):
+    """
+    串流回報 job 的進度、token 用量、預估剩餘時間與已產生的 persona，
+    job 目錄已有 personas_partial.zip 時，執行中（或失敗後）提供下載目前的部分結果，完成後改為最終的輸出檔案。
+    Gradio 以 async generator 的每次 yield 即時更新介面。
+    """
+    job_manager = get_job_manager()
+    job_id = (job_id or "").strip()
+    while True:
+        job = job_manager.get(job_id)
+        if job is None:
+            yield "查無此 job", None, None, None
+            return
+        finished = job["status"] in ("done", "failed")
+        if job["status"] == "done":
+            outputs = job["outputs"]
+        else:
+            partial_zip = os.path.join(job["dir"], JOB_PARTIAL_ZIP)
+            outputs = (None, partial_zip if os.path.exists(partial_zip) else None)
+        yield (format_job_status(job), persona_preview(job), *outputs)
+        if finished:
+            return
+        await asyncio.sleep(JOB_POLL_SECONDS)
@@ -0,0 +1,645 @@
+"""
+model client 的外層：回應快取（CachedChatCompletionClient）、重試與斷路器（ResilientChatCompletionClient）、
+多金鑰 × 多模型的端點路由（RoutedChatCompletionClient），由 build_model_client 組合起來。
+"""
+import os
+import asyncio
+import collections
+import time
+import random
+import email.utils
+import json
+import hashlib
+import sqlite3
+import threading
+import dataclasses
+
+import openai
+from autogen_core.models import ChatCompletionClient, CreateResult, RequestUsage
+from autogen_ext.models.openai import OpenAIChatCompletionClient
+
+from . import CACHE_DIR
+
+# LLM 回應快取設定：存放位置、容量上限，以及模式
+# "readwrite"：命中直接回傳，未命中時呼叫模型並寫入快取
+# "replay"：唯讀重播，命中直接回傳，未命中時呼叫模型但不寫入快取
+LLM_CACHE_PATH = os.path.join(CACHE_DIR, "llm_cache.sqlite3")
+LLM_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# 超過容量上限時一次淘汰到上限的這個比例以下，不必每次寫入都淘汰
+LLM_CACHE_EVICT_TO = 0.9
+LLM_CACHE_MODE = os.environ.get("LLM_CACHE_MODE", "readwrite")
+
+@dataclasses.dataclass
+class ServedUsage(RequestUsage):
+    """
+    附上實際回應的模型與端點名稱的用量。RoutedChatCompletionClient 把它放在 CreateResult.usage，
+    AssistantAgent 會原樣放進 TextMessage.models_usage，多模型路由時仍可依實際的模型統計用量與費用。
+    """
+    model: str = None
+    endpoint: str = None
+
+def served_model(usage, default=None):
+    """取出實際回應的模型；用量不是經由路由取得（或沒有用量）時回傳 default"""
+    return getattr(usage, "model", None) or default
+
+def served_endpoint(usage):
+    """取出實際回應的端點名稱，不是經由路由取得時回傳 None"""
+    return getattr(usage, "endpoint", None)
+
+class CachedChatCompletionClient(ChatCompletionClient):
+    """
+    包在 model_client 外層的回應快取，以 (model, messages, 參數) 的雜湊值為鍵，
+    回應存在 SQLite，超過容量上限時從最久沒用到的回應開始淘汰（LRU）。
+    重新執行相同的請求時不會再呼叫 Gemini。
+    命中快取的回應標記 cached=True 且用量為 0（沒有實際消耗 token），原本的用量另計在 saved_prompt_tokens／saved_completion_tokens；
+    快取一併保存當初回應的模型與端點，命中時仍以 ServedUsage 回報。
+    """
+
+    def __init__(self, client, model, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES, mode=LLM_CACHE_MODE):
+        self._client = client
+        self._model = model
+        self._max_bytes = max_bytes
+        self._mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 讀寫快取在執行緒中進行，不阻塞 event loop；同一個連線由 lock 保護，一次只有一個執行緒使用
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._db.commit()
+        # 快取的總大小在寫入時累加，不必每次寫入都掃描整張表
+        self._total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _cache_key(self, messages, tools, json_output, extra_create_args):
+        payload = {
+            "model": self._model,
+            "messages": [message.model_dump(mode="json") for message in messages],
+            "tools": [getattr(tool, "schema", tool) for tool in tools],
+            "json_output": json_output if isinstance(json_output, (bool, type(None))) else repr(json_output),
+            "extra_create_args": extra_create_args,
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _load(self, key):
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self._mode != "replay":
+                self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._db.commit()
+        data = json.loads(row[0])
+        result = CreateResult.model_validate(data)
+        self.saved_prompt_tokens += result.usage.prompt_tokens
+        self.saved_completion_tokens += result.usage.completion_tokens
+        result.cached = True
+        result.usage = ServedUsage(
+            prompt_tokens=0, completion_tokens=0, model=data["usage"].get("model"), endpoint=data["usage"].get("endpoint"),
+        )
+        return result
+
+    def _store(self, key, result):
+        if self._mode == "replay":
+            return
+        # CreateResult 依宣告的 RequestUsage 序列化會捨去模型與端點，另外以完整的用量覆寫
+        data = result.model_dump(mode="json")
+        data["usage"] = dataclasses.asdict(result.usage)
+        value = json.dumps(data, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        with self._db_lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            if self._total_bytes > self._max_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        """從最久沒用到的回應開始刪除，直到總大小降到上限的 LLM_CACHE_EVICT_TO 以下；呼叫端須持有 lock"""
+        # 其他程序也可能寫入同一個快取檔，淘汰前重新計算一次實際的總大小
+        self._total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = self._max_bytes * LLM_CACHE_EVICT_TO
+        if self._total_bytes <= self._max_bytes:
+            return
+        # 依 last_access 索引只讀取要刪除的那幾筆
+        count = 0
+        for (size,) in self._db.execute("SELECT size FROM responses ORDER BY last_access"):
+            if self._total_bytes <= target:
+                break
+            self._total_bytes -= size
+            count += 1
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)", (count,),
+        )
+
+    async def create(self, messages, *, tools=[], json_output=None, extra_create_args={}, cancellation_token=None):
+        key = self._cache_key(messages, tools, json_output, extra_create_args)
+        cached = await asyncio.to_thread(self._load, key)
+        if cached is not None:
+            return cached
+        result = await self._client.create(
+            messages, tools=tools, json_output=json_output,
+            extra_create_args=extra_create_args, cancellation_token=cancellation_token,
+        )
+        await asyncio.to_thread(self._store, key, result)
+        return result
+
+    async def create_stream(self, messages, *, tools=[], json_output=None, extra_create_args={}, cancellation_token=None):
+        key = self._cache_key(messages, tools, json_output, extra_create_args)
+        cached = await asyncio.to_thread(self._load, key)
+        if cached is not None:
+            yield cached
+            return
+        async for item in self._client.create_stream(
+            messages, tools=tools, json_output=json_output,
+            extra_create_args=extra_create_args, cancellation_token=cancellation_token,
+        ):
+            if isinstance(item, CreateResult):
+                await asyncio.to_thread(self._store, key, item)
+            yield item
+
+    async def close(self):
+        with self._db_lock:
+            self._db.close()
+        await self._client.close()
+
+    def actual_usage(self):
+        return self._client.actual_usage()
+
+    def total_usage(self):
+        return self._client.total_usage()
+
+    def count_tokens(self, messages, *, tools=[]):
+        return self._client.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages, *, tools=[]):
+        return self._client.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self):
+        return self._client.capabilities
+
+    def endpoint_stats(self):
+        return self._client.endpoint_stats()
+
+    @property
+    def model_info(self):
+        return self._client.model_info
+
+    @property
+    def model(self):
+        return self._model
+
+# 重試與斷路器設定：最多重試次數、指數退避的基準與上限秒數、連續失敗幾次後斷開與冷卻秒數
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN_SECONDS = 30.0
+# hedging：請求超過此秒數仍未回應（串流請求為尚未收到第一段內容）時，再送出一個相同的請求，取先回應者。
+# 被取消的請求仍可能已經計費，長回應會加倍費用，因此預設關閉（0），需要壓低尾端延遲時才以環境變數開啟，
+# 並應設定為明顯高於一般回應時間的秒數
+HEDGE_AFTER_SECONDS = float(os.environ.get("LLM_HEDGE_AFTER_SECONDS", "0"))
+# 可改指向其他相容 OpenAI 的端點，例如本機回傳 429 的測試伺服器
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL")
+
+def is_retryable(error):
+    """429、5xx 與連線錯誤（含逾時）值得重試，其餘錯誤直接丟出"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+def retry_after_seconds(error):
+    """讀取回應標頭的 Retry-After（秒數或 HTTP 日期），沒有時回傳 None"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return max(float(headers["retry-after-ms"]) / 1000, 0.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+def backoff_delay(attempt, error):
+    """優先依照 Retry-After，否則使用加上隨機抖動的指數退避（full jitter）"""
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_SECONDS)
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+class CircuitBreaker:
+    """
+    連續失敗達 failure_threshold 次就斷開 cooldown 秒，期間排程器不再放行新的批次、重試也先暫停；
+    冷卻結束後放行的請求若再失敗會立即再次斷開，成功則恢復正常。
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None and time.monotonic() - self._opened_at < self.cooldown
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if not self.is_open:
+                self.trips += 1
+                print(f"模型服務連續失敗 {self.failures} 次，暫停送出新請求 {self.cooldown:.0f} 秒")
+            self._opened_at = time.monotonic()
+
+    async def wait_until_closed(self):
+        while self.is_open:
+            await asyncio.sleep(self.cooldown - (time.monotonic() - self._opened_at))
+
+# 同一個模型服務共用的斷路器，model client 與排程器都參考它
+provider_breaker = CircuitBreaker()
+
+class ResilientChatCompletionClient(ChatCompletionClient):
+    """
+    包在 model_client 外層的重試層：可重試的錯誤以指數退避加抖動重試並遵守 Retry-After，
+    失敗次數回報給斷路器。
+    hedge_after 大於 0 時開啟 hedging：非串流請求回應過慢、或串流請求遲遲沒有第一段內容時，
+    送出第二個相同請求，取先回應者並取消另一個。
+    串流請求只在還沒收到任何內容前失敗時重試。
+    """
+
+    def __init__(self, client, breaker=provider_breaker, max_attempts=RETRY_MAX_ATTEMPTS, hedge_after=HEDGE_AFTER_SECONDS):
+        self._client = client
+        self._breaker = breaker
+        self._max_attempts = max_attempts
+        self._hedge_after = hedge_after
+        self.retries = 0
+        self.hedges = 0
+
+    async def _backoff(self, attempt, error):
+        """記錄失敗並等待退避時間；不可重試或已達上限時直接丟出錯誤"""
+        if not is_retryable(error):
+            raise error
+        self._breaker.record_failure()
+        if attempt == self._max_attempts - 1:
+            raise error
+        delay = backoff_delay(attempt, error)
+        self.retries += 1
+        print(f"模型呼叫失敗（{type(error).__name__}），{delay:.1f} 秒後重試（第 {attempt + 1} 次）")
+        await asyncio.sleep(delay)
+
+    async def _hedged_create(self, messages, **kwargs):
+        if not self._hedge_after:
+            return await self._client.create(messages, **kwargs)
+        first = asyncio.ensure_future(self._client.create(messages, **kwargs))
+        done, _ = await asyncio.wait({first}, timeout=self._hedge_after)
+        if done:
+            return first.result()
+        self.hedges += 1
+        second = asyncio.ensure_future(self._client.create(messages, **kwargs))
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+        # 兩個請求都失敗時，以第一個請求的錯誤為準
+        raise first.exception()
+
+    async def _hedged_stream(self, messages, **kwargs):
+        """
+        開啟串流並等待第一段內容；超過 hedge_after 秒仍沒有內容時再開一個相同的串流，
+        回傳 (先收到內容的串流, 第一段內容)，另一個串流取消並關閉。串流沒有任何內容就結束時第一段內容為 None。
+        """
+
+        async def first_item(stream):
+            try:
+                return await stream.__anext__()
+            except StopAsyncIteration:
+                return None
+
+        streams = {}
+        first_stream = self._client.create_stream(messages, **kwargs)
+        first = asyncio.ensure_future(first_item(first_stream))
+        streams[first] = first_stream
+        if self._hedge_after:
+            done, _ = await asyncio.wait({first}, timeout=self._hedge_after)
+            if not done:
+                self.hedges += 1
+                second_stream = self._client.create_stream(messages, **kwargs)
+                streams[asyncio.ensure_future(first_item(second_stream))] = second_stream
+        pending = set(streams)
+        winner = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task, stream in streams.items():
+            if task is not winner:
+                await stream.aclose()
+        if winner is None:
+            # 全部失敗時，以第一個串流的錯誤為準
+            raise first.exception()
+        return streams[winner], winner.result()
+
+    async def create(self, messages, *, tools=[], json_output=None, extra_create_args={}, cancellation_token=None):
+        for attempt in range(self._max_attempts):
+            await self._breaker.wait_until_closed()
+            try:
+                result = await self._hedged_create(
+                    messages, tools=tools, json_output=json_output,
+                    extra_create_args=extra_create_args, cancellation_token=cancellation_token,
+                )
+            except Exception as e:
+                await self._backoff(attempt, e)
+            else:
+                self._breaker.record_success()
+                return result
+
+    async def create_stream(self, messages, *, tools=[], json_output=None, extra_create_args={}, cancellation_token=None):
+        for attempt in range(self._max_attempts):
+            await self._breaker.wait_until_closed()
+            started = False
+            try:
+                stream, item = await self._hedged_stream(
+                    messages, tools=tools, json_output=json_output,
+                    extra_create_args=extra_create_args, cancellation_token=cancellation_token,
+                )
+                if item is not None:
+                    started = True
+                    yield item
+                    async for item in stream:
+                        yield item
+            except Exception as e:
+                if started:
+                    raise
+                await self._backoff(attempt, e)
+            else:
+                self._breaker.record_success()
+                return
+
+    async def close(self):
+        await self._client.close()
+
+    def actual_usage(self):
+        return self._client.actual_usage()
+
+    def total_usage(self):
+        return self._client.total_usage()
+
+    def count_tokens(self, messages, *, tools=[]):
+        return self._client.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages, *, tools=[]):
+        return self._client.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self):
+        return self._client.capabilities
+
+    def endpoint_stats(self):
+        return self._client.endpoint_stats()
+
+    @property
+    def model_info(self):
+        return self._client.model_info
+
+# 多組金鑰與模型：GEMINI_API_KEYS 以逗號分隔多把金鑰（未設定時使用 Gemini_api）
+# 預設只使用 DEFAULT_GEMINI_MODEL 一個模型，請求分散到各把金鑰；路由會偏好延遲較低的端點，
+# 混用不同品質的模型（例如加入 gemini-1.5-flash-8b）須以 GEMINI_MODELS（逗號分隔）明確開啟
+DEFAULT_GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_API_KEYS = [key.strip() for key in os.environ.get("GEMINI_API_KEYS", os.environ.get("Gemini_api") or "").split(",") if key.strip()]
+GEMINI_MODELS = [model.strip() for model in os.environ.get("GEMINI_MODELS", DEFAULT_GEMINI_MODEL).split(",") if model.strip()]
+# 每個端點（金鑰 × 模型）每分鐘的請求與 token 配額，以及延遲 EWMA 的平滑係數
+# 配額在每次 create／create_stream 呼叫時扣除，一個批次的 team 對話中每一輪發言都會計入
+ENDPOINT_REQUESTS_PER_MINUTE = 15
+ENDPOINT_TOKENS_PER_MINUTE = 1000000
+LATENCY_EWMA_ALPHA = 0.3
+# 端點失敗且沒有 Retry-After 時暫停使用的秒數
+ENDPOINT_COOLDOWN_SECONDS = 10.0
+
+class RoutedChatCompletionClient(ChatCompletionClient):
+    """
+    在多個端點（金鑰 × 模型）之間分配請求：每次挑選「延遲 EWMA ÷ 剩餘配額比例」最小的端點，
+    尚未量測過延遲的端點優先，讓每個端點都有機會被使用。
+    每次呼叫都計入該端點滑動一分鐘視窗內的請求數與（依 prompt 粗估的）token 數，配額用盡的端點暫不使用。
+    端點發生可重試的錯誤時暫停使用（依 Retry-After 或 ENDPOINT_COOLDOWN_SECONDS），並立即改用下一個端點；
+    所有端點都失敗時才把錯誤丟給外層的重試層處理退避。
+    回傳的 CreateResult.usage 為 ServedUsage，記錄實際回應的模型與端點。
+    """
+
+    def __init__(self, endpoints, rpm=ENDPOINT_REQUESTS_PER_MINUTE, tpm=ENDPOINT_TOKENS_PER_MINUTE):
+        # endpoints: [(名稱, 模型, model client)]
+        self._endpoints = [
+            {"name": name, "model": model, "client": client, "latency": None, "window": collections.deque(),
+             "cooldown_until": 0.0, "calls": 0, "failures": 0, "prompt_tokens": 0, "completion_tokens": 0}
+            for name, model, client in endpoints
+        ]
+        self._rpm = rpm
+        self._tpm = tpm
+
+    def _remaining(self, endpoint, now, tokens=0):
+        """端點在滑動一分鐘視窗內剩餘的配額比例（請求數與 token 數取較小者）；放不下這次的 token 時為 0"""
+        window = endpoint["window"]
+        while window and now - window[0][0] >= 60:
+            window.popleft()
+        used_tokens = sum(t for _, t in window)
+        # 單次請求超過整個 token 配額時，只要視窗淨空就放行，避免永遠等待
+        if window and used_tokens + tokens > self._tpm:
+            return 0.0
+        return min(max(self._rpm - len(window), 0) / self._rpm, max(self._tpm - used_tokens, 0) / self._tpm)
+
+    def _resume_at(self, endpoint, now, tokens=0):
+        """端點可以再次使用的時間：暫停結束且每分鐘配額有空位（配額用盡時以視窗中最早的請求滑出為準）"""
+        window = endpoint["window"]
+        quota_free = window[0][0] + 60 if self._remaining(endpoint, now, tokens) == 0 else 0.0
+        return max(endpoint["cooldown_until"], quota_free)
+
+    async def _candidates(self, tokens=0):
+        """依分數排序目前可用的端點；全部暫停或配額用盡時，等到最早恢復的端點可用為止"""
+        while True:
+            now = time.monotonic()
+            scored = []
+            for endpoint in self._endpoints:
+                remaining = self._remaining(endpoint, now, tokens)
+                if endpoint["cooldown_until"] > now or remaining == 0:
+                    continue
+                latency = endpoint["latency"] or 0.0
+                scored.append((latency / remaining, endpoint["calls"], endpoint))
+            if scored:
+                return [endpoint for _, _, endpoint in sorted(scored, key=lambda item: item[:2])]
+            wait = min(self._resume_at(endpoint, now, tokens) for endpoint in self._endpoints) - now
+            await asyncio.sleep(min(max(wait, 0.01), RETRY_MAX_SECONDS))
+
+    def _record_success(self, endpoint, started, result=None):
+        elapsed = time.monotonic() - started
+        previous = endpoint["latency"]
+        endpoint["latency"] = elapsed if previous is None else LATENCY_EWMA_ALPHA * elapsed + (1 - LATENCY_EWMA_ALPHA) * previous
+        if result is not None:
+            self._record_usage(endpoint, result)
+
+    def _record_usage(self, endpoint, result):
+        endpoint["prompt_tokens"] += result.usage.prompt_tokens
+        endpoint["completion_tokens"] += result.usage.completion_tokens
+        result.usage = ServedUsage(
+            prompt_tokens=result.usage.prompt_tokens, completion_tokens=result.usage.completion_tokens,
+            model=endpoint["model"], endpoint=endpoint["name"],
+        )
+
+    def _record_failure(self, endpoint, error):
+        endpoint["failures"] += 1
+        delay = retry_after_seconds(error)
+        endpoint["cooldown_until"] = time.monotonic() + (ENDPOINT_COOLDOWN_SECONDS if delay is None else delay)
+        print(f"端點 {endpoint['name']} 呼叫失敗（{type(error).__name__}），改用其他端點")
+
+    def _start(self, endpoint, tokens):
+        endpoint["calls"] += 1
+        endpoint["window"].append((time.monotonic(), tokens))
+        return time.monotonic()
+
+    async def create(self, messages, *, tools=[], json_output=None, extra_create_args={}, cancellation_token=None):
+        error = None
+        tokens = estimate_message_tokens(messages)
+        for endpoint in await self._candidates(tokens):
+            started = self._start(endpoint, tokens)
+            try:
+                result = await endpoint["client"].create(
+                    messages, tools=tools, json_output=json_output,
+                    extra_create_args=extra_create_args, cancellation_token=cancellation_token,
+                )
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self._record_failure(endpoint, e)
+                error = e
+            else:
+                self._record_success(endpoint, started, result)
+                return result
+        raise error
+
+    async def create_stream(self, messages, *, tools=[], json_output=None, extra_create_args={}, cancellation_token=None):
+        error = None
+        tokens = estimate_message_tokens(messages)
+        for endpoint in await self._candidates(tokens):
+            started = self._start(endpoint, tokens)
+            yielded = False
+            try:
+                async for item in endpoint["client"].create_stream(
+                    messages, tools=tools, json_output=json_output,
+                    extra_create_args=extra_create_args, cancellation_token=cancellation_token,
+                ):
+                    if not yielded:
+                        # 串流以收到第一段內容的時間作為延遲
+                        self._record_success(endpoint, started)
+                        yielded = True
+                    if isinstance(item, CreateResult):
+                        self._record_usage(endpoint, item)
+                    yield item
+                return
+            except Exception as e:
+                if yielded or not is_retryable(e):
+                    raise
+                self._record_failure(endpoint, e)
+                error = e
+        raise error
+
+    def endpoint_stats(self):
+        """各端點的呼叫次數、失敗次數、延遲 EWMA 與 token 用量"""
+        return [
+            {key: endpoint[key] for key in ("name", "model", "calls", "failures", "latency", "prompt_tokens", "completion_tokens")}
+            for endpoint in self._endpoints
+        ]
+
+    async def close(self):
+        for endpoint in self._endpoints:
+            await endpoint["client"].close()
+
+    def actual_usage(self):
+        usages = [endpoint["client"].actual_usage() for endpoint in self._endpoints]
+        return RequestUsage(
+            prompt_tokens=sum(usage.prompt_tokens for usage in usages),
+            completion_tokens=sum(usage.completion_tokens for usage in usages),
+        )
+
+    def total_usage(self):
+        usages = [endpoint["client"].total_usage() for endpoint in self._endpoints]
+        return RequestUsage(
+            prompt_tokens=sum(usage.prompt_tokens for usage in usages),
+            completion_tokens=sum(usage.completion_tokens for usage in usages),
+        )
+
+    def count_tokens(self, messages, *, tools=[]):
+        return self._endpoints[0]["client"].count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages, *, tools=[]):
+        return self._endpoints[0]["client"].remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self):
+        return self._endpoints[0]["client"].capabilities
+
+    @property
+    def model_info(self):
+        return self._endpoints[0]["client"].model_info
+
+def build_model_client(model=None):
+    """
+    建立 model client：每把金鑰 × 每個模型各一個端點，由 RoutedChatCompletionClient 分配請求，
+    外層依序包上重試／斷路器與回應快取（快取命中時不經過重試層）。
+    未指定 model 時使用 GEMINI_MODELS（預設只有 DEFAULT_GEMINI_MODEL），指定時只使用該模型。
+    client 的 model 屬性是所有模型名稱以 + 相連，只供顯示；各次回應實際使用的模型見 served_model。
+    """
+    models = [model] if model else GEMINI_MODELS
+    kwargs = {"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else {}
+    # 重試交給 ResilientChatCompletionClient 處理，關閉 openai 套件內建的重試
+    endpoints = [
+        (f"{model_name}#{i + 1}", model_name, OpenAIChatCompletionClient(model=model_name, api_key=key, max_retries=0, **kwargs))
+        for i, key in enumerate(GEMINI_API_KEYS or [None])
+        for model_name in models
+    ]
+    return CachedChatCompletionClient(ResilientChatCompletionClient(RoutedChatCompletionClient(endpoints)), "+".join(models))
+
+def estimate_tokens(text):
+    """粗估文字的 token 數：中日韓字元約 1 token，其餘約 4 字元 1 token"""
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk) // 4 + 1
+
+def estimate_message_tokens(messages):
+    """粗估一次請求的 prompt token 數，供端點的每分鐘 token 配額使用；非文字內容（例如圖片）不計"""
+    total = 0
+    for message in messages:
+        content = getattr(message, "content", "")
+        parts = content if isinstance(content, list) else [content]
+        total += sum(estimate_tokens(part) for part in parts if isinstance(part, str))
+    return total
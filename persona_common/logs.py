@@ -0,0 +1,115 @@
+"""
+對話紀錄的串流寫入（csv / jsonl / parquet）與查詢。
+"""
+import os
+import csv
+import json
+
+import pandas as pd
+
+# 對話紀錄的輸出格式（csv / jsonl / parquet）與欄位型別；parquet 需要另外安裝 pyarrow
+# persona_model、endpoint 為實際回應該則訊息的模型與端點（多模型路由時各訊息可能不同）
+LOG_FORMAT = os.environ.get("CONVERSATION_LOG_FORMAT", "csv")
+LOG_COLUMNS = {
+    "batch_start": "int",
+    "batch_end": "int",
+    "source": "str",
+    "content": "str",
+    "type": "str",
+    "prompt_tokens": "int",
+    "completion_tokens": "int",
+    "chunk_tokens_saved": "int",
+    "stop_reason": "str",
+    "persona_model": "str",
+    "endpoint": "str",
+}
+
+class ConversationLogWriter:
+    """
+    邊處理邊寫入對話紀錄，不在記憶體中累積整份紀錄。
+    每個批次寫入一次：csv / jsonl 寫入後立即 flush，中途失敗時已完成批次的紀錄仍會保留；
+    parquet 每個批次寫成一個 row group，之後可依 batch_start / source 只讀取需要的部分。
+    """
+
+    def __init__(self, path, fmt=LOG_FORMAT, columns=LOG_COLUMNS):
+        self.path = path
+        self.fmt = fmt
+        self.columns = columns
+        self.rows = 0
+        self._file = None
+        if fmt == "parquet":
+            # pyarrow 為選用套件，只有輸出 Parquet 時才載入
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._pa = pa
+            self._schema = pa.schema([(name, pa.int64() if kind == "int" else pa.string()) for name, kind in columns.items()])
+            self._writer = pq.ParquetWriter(path, self._schema)
+        elif fmt == "jsonl":
+            self._file = open(path, "w", encoding="utf-8")
+        else:
+            self._file = open(path, "w", encoding="utf-8-sig", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=list(columns), extrasaction="ignore")
+            self._writer.writeheader()
+
+    def _coerce(self, row):
+        coerced = {}
+        for name, kind in self.columns.items():
+            value = row.get(name)
+            if value is None or (isinstance(value, float) and value != value):
+                coerced[name] = None
+            else:
+                coerced[name] = int(value) if kind == "int" else str(value)
+        return coerced
+
+    def write_chunk(self, rows):
+        """寫入一個批次的對話紀錄"""
+        if not rows:
+            return
+        rows = [self._coerce(row) for row in rows]
+        if self.fmt == "parquet":
+            self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+        elif self.fmt == "jsonl":
+            self._file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+        else:
+            self._writer.writerows(rows)
+        if self._file:
+            self._file.flush()
+        self.rows += len(rows)
+
+    def close(self):
+        if self.fmt == "parquet":
+            self._writer.close()
+        else:
+            self._file.close()
+        print(f"對話紀錄共 {self.rows} 筆，已寫入 {self.path}")
+
+def conversation_log_path(fmt=LOG_FORMAT):
+    return f"all_conve_log.{fmt}"
+
+def read_log(path, batch_start=None, source=None, columns=None):
+    """
+    查詢對話紀錄，可依 batch_start / source 篩選。
+    Parquet 檔以 filters 交給 pyarrow，依 row group 統計略過不符合的批次；csv / jsonl 則分段讀取後篩選。
+    """
+    filters = []
+    if batch_start is not None:
+        filters.append(("batch_start", "==", batch_start))
+    if source is not None:
+        filters.append(("source", "==", source))
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return pq.read_table(path, columns=columns, filters=filters or None).to_pandas()
+    if path.endswith(".jsonl"):
+        reader = pd.read_json(path, lines=True, chunksize=10000)
+    else:
+        reader = pd.read_csv(path, chunksize=10000, encoding="utf-8-sig")
+    parts = []
+    for part in reader:
+        if batch_start is not None:
+            part = part[part["batch_start"] == batch_start]
+        if source is not None:
+            part = part[part["source"] == source]
+        parts.append(part[columns] if columns else part)
+    if not parts:
+        return pd.DataFrame(columns=columns or list(LOG_COLUMNS))
+    return pd.concat(parts, ignore_index=True)
@@ -0,0 +1,100 @@
+"""
+將各批次產生的 persona 分層合併、去除重複。
+"""
+import json
+
+from autogen_core.models import UserMessage
+
+from .personas import JsonStreamExtractor
+from .scheduler import run_scheduled
+
+# 分層合併 persona 時，每次最多合併幾組
+REDUCE_FAN_IN = 8
+
+def assign_covered_rows(personas, n_rows):
+    """將批次的問卷筆數平均分配給該批次產生的 persona，已有 covered_rows 的保留原值"""
+    for i, persona in enumerate(personas):
+        if not isinstance(persona.get("covered_rows"), int):
+            persona["covered_rows"] = n_rows // len(personas) + (1 if i < n_rows % len(personas) else 0)
+
+def parse_json_array(text):
+    """從模型回覆中取出 JSON 陣列裡的所有物件（可能包在 ```json 區塊內），找不到時回傳 None"""
+    return JsonStreamExtractor().feed(text) or None
+
+def attribute_covered_rows(personas, merged):
+    """
+    依模型回覆的 merged_from（被合併的來源編號）在程式中加總 covered_rows，不採用模型自行計算的數字。
+    每個來源只計入第一個引用它的 persona；沒有被任何 persona 引用的來源原樣保留，問卷筆數不會遺失。
+    有 persona 缺少 merged_from 時無法歸屬筆數，回傳 None 視為合併失敗。
+    """
+    claimed = set()
+    result = []
+    for persona in merged:
+        sources = persona.pop("merged_from", None)
+        persona.pop("covered_rows", None)
+        if not isinstance(sources, list) or not sources:
+            return None
+        indexes = []
+        for source in sources:
+            try:
+                index = int(source)
+            except (TypeError, ValueError):
+                continue
+            if 0 <= index < len(personas) and index not in claimed:
+                claimed.add(index)
+                indexes.append(index)
+        persona["covered_rows"] = sum(personas[index].get("covered_rows", 0) for index in indexes)
+        result.append(persona)
+    result.extend(persona for index, persona in enumerate(personas) if index not in claimed)
+    return result
+
+async def merge_persona_group(model_client, group):
+    """
+    請模型將一組 persona 清單合併並去除重複，並列出每個合併結果來自哪些輸入（merged_from），
+    covered_rows 由程式依來源加總；合併失敗時保留原清單
+    """
+    personas = [persona for personas in group for persona in personas]
+    if len(group) == 1:
+        return personas
+    # 各批次的 persona_id 可能重複，改以在清單中的位置作為來源編號；covered_rows 不交給模型
+    numbered = [
+        {"source": index, **{k: v for k, v in persona.items() if k != "covered_rows"}}
+        for index, persona in enumerate(personas)
+    ]
+    prompt = (
+        "以下是由不同批次問卷資料產生的 persona 清單，其中有許多重複或相近的 persona，source 為每個 persona 的來源編號：\n"
+        f"{json.dumps(numbered, ensure_ascii=False)}\n\n"
+        "請合併相近的 persona 並去除重複，只保留彼此有明顯差異的 persona。\n"
+        "請只輸出一個 JSON 陣列，每個元素的欄位與輸入相同（persona_id, description, motivation, challenges, "
+        "learning_goals, preferred_learning_methods, suggested_learning_resources），"
+        "不含 source，另加上 merged_from：被合併進該 persona 的所有來源編號（整數陣列），每個來源編號只能出現一次。"
+    )
+    response = await model_client.create([UserMessage(content=prompt, source="user")])
+    merged = parse_json_array(response.content)
+    if merged:
+        for persona in merged:
+            persona.pop("source", None)
+        merged = attribute_covered_rows(personas, merged)
+    if not merged:
+        print("合併 persona 失敗，保留未合併的清單")
+        return personas
+    return merged
+
+async def reduce_personas(model_client, chunk_personas, fan_in=REDUCE_FAN_IN):
+    """
+    以樹狀方式分層合併各批次的 persona：每層每 fan_in 組合併成一組並透過排程器平行執行，
+    直到只剩一組。層數與每次 prompt 的大小都只隨批次數呈對數成長，不會產生單一巨大的 prompt。
+    """
+    level = [personas for personas in chunk_personas if personas]
+    depth = 0
+    while len(level) > 1:
+        groups = [level[i:i + fan_in] for i in range(0, len(level), fan_in)]
+        depth += 1
+        print(f"第 {depth} 層合併：{len(level)} 組 persona 合併為 {len(groups)} 組")
+        results = await run_scheduled([lambda group=group: merge_persona_group(model_client, group) for group in groups])
+        # 合併失敗的組直接保留原本的 persona，不會遺失
+        level = [
+            merged if merged is not None else [persona for personas in group for persona in personas]
+            for merged, group in zip(results, groups)
+        ]
+    return level[0] if level else []
@@ -0,0 +1,415 @@
+"""
+persona 的 schema 驗證、從模型輸出中串流擷取 JSON，以及 JSON Lines / ZIP 輸出。
+"""
+import os
+import asyncio
+import collections
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import re
+import shutil
+import zipfile
+
+# persona 的欄位定義：文字欄位、學習資源清單與資源內的文字欄位
+PERSONA_SCHEMA = {
+    "persona_id": "id",
+    "description": "text",
+    "motivation": "text",
+    "challenges": "text",
+    "learning_goals": "text",
+    "preferred_learning_methods": "text",
+    "suggested_learning_resources": {
+        "feature_name": "text",
+        "description": "text",
+        "justification": "text",
+    },
+}
+# 視為未填寫的內容（模型直接照抄格式範例時常見）
+PLACEHOLDER_VALUES = {"", "...", "…", "null", "none", "n/a", "未知"}
+# fill_missing=True 時，缺少或無效欄位補上的預設值
+MISSING_VALUE = "未知"
+
+def normalize_text(value):
+    """將欄位值轉成字串，回傳 (字串, 錯誤原因)；無法使用時字串為 None"""
+    if value is None:
+        return None, "missing"
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    elif isinstance(value, (list, tuple)):
+        value = "；".join(str(v).strip() for v in value if v is not None and str(v).strip())
+    elif isinstance(value, dict):
+        value = json.dumps(value, ensure_ascii=False, default=str)
+    elif not isinstance(value, str):
+        value = str(value)
+    value = value.strip()
+    if value.lower() in PLACEHOLDER_VALUES:
+        return None, "placeholder"
+    return value, None
+
+def normalize_extra(value):
+    """未定義在 schema 中的欄位只確保可以序列化成 JSON"""
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {str(k): normalize_extra(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [normalize_extra(v) for v in value]
+    return str(value)
+
+def compile_persona_schema(schema):
+    """
+    將 schema 預先編譯成欄位檢查函式清單，之後每個 persona 只需依序套用，不必重新解讀 schema。
+    回傳的函式 validate(persona, errors, fill_missing) 會回傳修正後的 persona，
+    無法修正時回傳 None；錯誤依「欄位 -> 原因」記錄在 errors 中。
+    """
+    def text_checker(field, prefix=""):
+        def check(src, dst, errors, fill_missing):
+            value, reason = normalize_text(src.get(field))
+            if reason:
+                errors[f"{prefix}{field}"][reason] += 1
+                if not fill_missing:
+                    return False
+                value = MISSING_VALUE
+            dst[field] = value
+            return True
+        return check
+
+    def id_checker(field):
+        def check(src, dst, errors, fill_missing):
+            value = src.get(field)
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            value, reason = normalize_text(value)
+            if reason:
+                # persona_id 之後會重新編號，缺少時不視為無效
+                errors[field][reason] += 1
+                value = ""
+            dst[field] = value
+            return True
+        return check
+
+    def list_checker(field, item_checkers):
+        def check(src, dst, errors, fill_missing):
+            value = src.get(field)
+            if isinstance(value, dict):
+                value = [value]
+            if not isinstance(value, list):
+                errors[field]["missing" if value is None else "type"] += 1
+                if not fill_missing:
+                    return False
+                value = []
+            items = []
+            for item in value:
+                if not isinstance(item, dict):
+                    errors[field]["type"] += 1
+                    continue
+                fixed = {}
+                # 任一欄位無效的資源直接捨棄，不影響其他資源
+                if all(checker(item, fixed, errors, False) for checker in item_checkers):
+                    items.append(fixed)
+            if not items:
+                errors[field]["empty"] += 1
+                if not fill_missing:
+                    return False
+            dst[field] = items
+            return True
+        return check
+
+    checkers = []
+    for field, kind in schema.items():
+        if isinstance(kind, dict):
+            checkers.append(list_checker(field, [text_checker(f, f"{field}.") for f in kind]))
+        elif kind == "id":
+            checkers.append(id_checker(field))
+        else:
+            checkers.append(text_checker(field))
+
+    def validate(persona, errors, fill_missing=False):
+        fixed = {}
+        for checker in checkers:
+            if not checker(persona, fixed, errors, fill_missing):
+                return None
+        # schema 以外的欄位（例如 covered_rows）原樣保留在後面
+        fixed.update((key, normalize_extra(value)) for key, value in persona.items() if key not in schema)
+        return fixed
+
+    return validate
+
+_validate_persona = compile_persona_schema(PERSONA_SCHEMA)
+
+def validate_personas(personas, fill_missing=False):
+    """
+    一次驗證並修正一批 persona。
+    fill_missing=False 時捨棄缺少必要欄位或只有範例內容的 persona；
+    fill_missing=True 時改為補上預設值並保留。
+    回傳 (有效的 persona 清單, 統計資料)，統計資料包含各欄位的錯誤次數。
+    """
+    errors = collections.defaultdict(collections.Counter)
+    valid = []
+    rejected = 0
+    for persona in personas:
+        if not isinstance(persona, dict):
+            errors["persona"]["type"] += 1
+            rejected += 1
+            continue
+        fixed = _validate_persona(persona, errors, fill_missing)
+        if fixed is None:
+            rejected += 1
+        else:
+            valid.append(fixed)
+    stats = {
+        "total": len(personas),
+        "valid": len(valid),
+        "rejected": rejected,
+        "field_errors": {field: dict(reasons) for field, reasons in errors.items()},
+    }
+    return valid, stats
+
+def print_validation_stats(stats):
+    """輸出 persona 驗證結果與各欄位的錯誤統計"""
+    print(f"persona 驗證：共 {stats['total']} 筆，有效 {stats['valid']} 筆，捨棄 {stats['rejected']} 筆")
+    for field, reasons in sorted(stats["field_errors"].items()):
+        print(f"  {field}: " + ", ".join(f"{reason} {count}" for reason, count in sorted(reasons.items())))
+
+class JsonStreamExtractor:
+    """
+    逐段讀入模型輸出的文字，以括號深度狀態機找出其中的 JSON 物件與陣列，不需要 ```json 區塊也能辨識。
+    每當一個物件的右大括號出現（且外層只有陣列），就立即解析並回傳該物件，
+    因此 persona 陣列中的每個 persona 都會在輸出完成時馬上取得，整段文字只掃描一次。
+    """
+
+    def __init__(self):
+        self._stack = []        # 目前尚未關閉的括號，元素為 (括號字元, 在 buffer 中的起始位置)
+        self._buffer = []       # 最外層括號開始後的文字
+        self._in_string = False
+        self._escape = False
+        self.errors = 0         # 無法解析的物件數
+
+    def feed(self, text):
+        """讀入一段文字，回傳這段文字中完成的 dict 清單"""
+        completed = []
+        for ch in text:
+            if not self._stack:
+                if ch in "{[":
+                    self._stack.append((ch, 0))
+                    self._buffer = [ch]
+                continue
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._stack.append((ch, len(self._buffer) - 1))
+            elif ch in "}]":
+                opener, start = self._stack.pop()
+                if (opener == "{") != (ch == "}"):
+                    # 括號不成對，代表這段不是 JSON，捨棄後重新尋找
+                    self._reset()
+                    continue
+                if opener == "{" and all(o == "[" for o, _ in self._stack):
+                    try:
+                        parsed = json.loads("".join(self._buffer[start:]))
+                    except json.JSONDecodeError:
+                        self.errors += 1
+                    else:
+                        completed.append(parsed)
+                if not self._stack:
+                    self._buffer = []
+        return completed
+
+    def _reset(self):
+        self._stack = []
+        self._buffer = []
+        self._in_string = False
+        self._escape = False
+
+# persona 輸出檔案超過此大小就輪替並壓縮舊檔；每批最多合併寫入幾個 persona、等待累積的秒數
+PERSONA_SINK_MAX_BYTES = 50 * 1024 * 1024
+PERSONA_SINK_BATCH_SIZE = 256
+PERSONA_SINK_FLUSH_SECONDS = 0.5
+
+def gzip_file(path):
+    """將檔案壓縮為 <path>.gz 並刪除原檔"""
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+
+class PersonaSink:
+    """
+    persona 輸出的唯一寫入者：各批次把 persona 放進佇列，由單一背景 task 持有檔案，
+    批次合併成 JSON Lines（一行一個 persona）後一次寫入，避免多個批次交錯寫壞檔案。
+    檔案超過 max_bytes 時輪替，舊檔壓縮為 <path>.<n>.gz。
+    """
+
+    def __init__(self, path, max_bytes=PERSONA_SINK_MAX_BYTES, batch_size=PERSONA_SINK_BATCH_SIZE,
+                 flush_seconds=PERSONA_SINK_FLUSH_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self.rotations = 0
+        self._queue = asyncio.Queue()
+        self._file = None
+        self._task = None
+
+    def start(self):
+        """清除上次的輸出並開始背景寫入"""
+        for old in glob.glob(glob.escape(self.path) + ".*.gz"):
+            os.remove(old)
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, persona):
+        self._queue.put_nowait(persona)
+
+    async def close(self):
+        """寫完佇列中剩餘的 persona 後關閉檔案"""
+        self._queue.put_nowait(None)
+        await self._task
+        self._file.close()
+        print(f"persona 輸出完成：{self.written} 筆寫入 {self.path}，輪替 {self.rotations} 次")
+
+    async def _run(self):
+        closing = False
+        while not closing:
+            batch = [await self._queue.get()]
+            if batch[0] is not None:
+                # 等待一小段時間，讓其他批次的 persona 累積後一起寫入
+                await asyncio.sleep(self.flush_seconds)
+            while not self._queue.empty() and len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+            lines = []
+            for persona in batch:
+                if persona is None:
+                    closing = True
+                else:
+                    lines.append(json.dumps(persona, ensure_ascii=False, default=str) + "\n")
+            if lines:
+                self._file.write("".join(lines))
+                self._file.flush()
+                self.written += len(lines)
+                if self._file.tell() >= self.max_bytes:
+                    await self._rotate()
+
+    async def _rotate(self):
+        self._file.close()
+        self.rotations += 1
+        rotated = f"{self.path}.{self.rotations}"
+        os.replace(self.path, rotated)
+        self._file = open(self.path, "w", encoding="utf-8")
+        await asyncio.to_thread(gzip_file, rotated)
+
+def stable_persona_key(persona):
+    """以 persona 內容（不含 persona_id 與 covered_rows）的雜湊作為穩定識別碼"""
+    content = {k: v for k, v in persona.items() if k not in ("persona_id", "covered_rows")}
+    raw = json.dumps(content, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+class PersonaZipWriter:
+    """
+    以 writestr 直接從記憶體寫入 ZIP，不產生暫存的 PERSONA-*.json 檔案；整個寫入過程只開啟一次 ZIP，close 時寫入目錄。
+    內容相同的 persona 只寫入一次；persona_id 重複但內容不同時，檔名加上穩定識別碼區分，不會互相覆蓋。
+    persona_id 來自模型輸出，檔名只保留文字、數字、底線與連字號，不會產生 / 或 .. 這類跳出目錄的名稱。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._keys = set()
+        self._names = set()
+        self._zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, personas):
+        """寫入一批 persona，回傳實際寫入的數量"""
+        added = 0
+        for persona in personas:
+            key = stable_persona_key(persona)
+            if key in self._keys:
+                continue
+            self._keys.add(key)
+            persona_id = re.sub(r"[^\w-]+", "_", str(persona.get("persona_id") or "")).strip("_")[:64]
+            name = f"PERSONA-{persona_id or key}.json"
+            if name in self._names:
+                name = f"PERSONA-{persona_id}-{key}.json"
+            self._names.add(name)
+            self._zip.writestr(name, json.dumps(persona, ensure_ascii=False, indent=4))
+            added += 1
+        return added
+
+    def close(self):
+        self._zip.close()
+
+def publish_persona_zip(personas, path):
+    """
+    把目前所有的 persona 寫成完整的 ZIP 後以 os.replace 換上，
+    處理途中提供下載的 ZIP 隨時都是完整的檔案，不會讀到寫到一半的內容。
+    """
+    with PersonaZipWriter(path + ".tmp") as writer:
+        written = writer.add(personas)
+    os.replace(path + ".tmp", path)
+    return written
+
+# 處理途中的部分結果 ZIP 最多每隔幾秒重新發布一次
+PARTIAL_ZIP_PUBLISH_SECONDS = 10.0
+
+class PartialZipPublisher:
+    """
+    與 PersonaSink 相同的介面（start、put、close），把目前為止的 persona 發布為處理途中可下載的 ZIP。
+    由單一背景 task 收集 persona，每隔 publish_seconds 最多以 publish_persona_zip 重新發布一次，
+    壓縮與寫檔在執行緒中進行，不佔用各批次寫入紀錄的 lock；重新發布的次數只隨執行時間成長，不隨批次數成長。
+    """
+
+    def __init__(self, path, publish_seconds=PARTIAL_ZIP_PUBLISH_SECONDS):
+        self.path = path
+        self.publish_seconds = publish_seconds
+        self.publishes = 0
+        self._personas = []
+        self._queue = asyncio.Queue()
+        self._closing = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, persona):
+        self._queue.put_nowait(persona)
+
+    async def close(self):
+        """不再等待累積，立即發布最後一次並結束背景 task"""
+        self._closing.set()
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def _run(self):
+        closing = False
+        while not closing:
+            batch = [await self._queue.get()]
+            if batch[0] is not None:
+                # 等待一段時間，讓其他批次的 persona 累積後一起發布；close 時提前結束等待
+                try:
+                    await asyncio.wait_for(self._closing.wait(), self.publish_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            closing = None in batch
+            self._personas.extend(persona for persona in batch if persona is not None)
+            await asyncio.to_thread(publish_persona_zip, self._personas, self.path)
+            self.publishes += 1
@@ -0,0 +1,312 @@
+"""
+問卷 CSV 產生 persona 的共用流程：逐批執行 team（process_chunk），以及掃描、checkpoint、增量模式、
+排程、合併與驗證的整體流程（run_pipeline）。各腳本只提供批次的 prompt 與最終輸出的格式。
+"""
+import os
+import time
+import asyncio
+import hashlib
+
+import pandas as pd
+from autogen_agentchat.base import TaskResult
+from autogen_agentchat.messages import TextMessage, ModelClientStreamingChunkEvent
+
+from .llm import provider_breaker, GEMINI_API_KEYS, build_model_client, served_model, served_endpoint
+from .ingest import scan_csv, read_csv_chunks
+from .checkpoint import (
+    load_journal, append_journal, clear_journal, chunk_fingerprint, load_manifest, save_manifest,
+)
+from .interviews import build_interview_digest, research_learning_resources
+from .scheduler import MAX_CONCURRENT_TEAMS, run_scheduled
+from .encoders import DEFAULT_CHUNK_ENCODER, encode_chunk
+from .usage import UsageTracker
+from .personas import validate_personas, print_validation_stats, JsonStreamExtractor
+from .merge import assign_covered_rows, reduce_personas
+from .team import create_team_pool, CASCADE_ENABLED, CASCADE_DRAFT_MODEL, full_team_model, draft_personas
+from .logs import ConversationLogWriter, conversation_log_path
+
+# 每批次的問卷筆數
+CHUNK_ROWS = 1000
+
+async def process_chunk(chunk, start_idx, total_records, team_pool, build_prompt, persona_sink,
+                        encoder=DEFAULT_CHUNK_ENCODER, usage=None, on_event=None, echo_messages=True):
+    """
+    處理單一批次資料，從 agent 回應中提取所有與 persona 相關的敘述並交給 persona_sink 寫入。
+    build_prompt(chunk_data, start_idx, end_idx, total_records) 產生本批次的 prompt；
+    echo_messages=False 時不在終端機輸出每則對話內容。回傳本批次的 (對話紀錄, persona)。
+    """
+    chunk_data, encode_stats = encode_chunk(chunk, encoder)
+    end_idx = start_idx + len(chunk) - 1
+    print(f"處理批次起始索引 {start_idx}, 批次筆數: {len(chunk)}")
+    print(f"批次資料使用 {encoder} 格式，省下約 {encode_stats['tokens_saved']} tokens")
+    prompt = build_prompt(chunk_data, start_idx, end_idx, total_records)
+
+    messages = []
+    personas = []
+
+    def emit(event):
+        # 即時回報 persona 與 token 用量給呼叫端（例如背景 job 的進度顯示）
+        if on_event is not None:
+            on_event(dict(event, batch_start=start_idx))
+
+    # 串接模式：草稿通過驗證與信心檢查就直接採用，不必啟動整個 team
+    draft_model = team_pool.get("draft_model")
+    if draft_model is not None:
+        started = time.perf_counter()
+        response, drafted, confident = await draft_personas(team_pool, prompt)
+        if response is not None:
+            if usage is not None:
+                usage.record_message(start_idx, "draft_agent", served_model(response.usage, draft_model), response.usage, cached=response.cached)
+            messages.append({
+                "batch_start": start_idx,
+                "batch_end": end_idx,
+                "source": "draft_agent",
+                "content": response.content,
+                "type": "TextMessage",
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+                "chunk_tokens_saved": encode_stats["tokens_saved"],
+                "persona_model": served_model(response.usage, draft_model),
+                "endpoint": served_endpoint(response.usage),
+            })
+            emit({"type": "usage", "prompt_tokens": response.usage.prompt_tokens, "completion_tokens": response.usage.completion_tokens})
+        if confident:
+            for persona in drafted:
+                personas.append(persona)
+                persona_sink.put(persona)
+                emit({"type": "persona", "persona": persona})
+            if usage is not None:
+                elapsed = time.perf_counter() - started
+                usage.record_chunk(start_idx, elapsed, elapsed, 1, "draft accepted")
+            for row in messages:
+                row["stop_reason"] = "draft accepted"
+            print(f"批次 {start_idx} 採用 {draft_model} 的草稿，共 {len(drafted)} 個 persona")
+            print("本批次資料處理完成。")
+            return messages, personas
+        print(f"批次 {start_idx} 的草稿未通過驗證，改由 {team_pool['model']} 的完整 team 處理")
+
+    # 從 team pool 借用一組閒置的 team，重置狀態後使用，結束後歸還
+    local_team, stop_signal = await team_pool["queue"].get()
+    # 計時從借到 team 開始算起，不含等待閒置 team 的時間
+    started = time.perf_counter()
+    first_event_seconds = None
+    rounds = 0
+    stop_reason = None
+    try:
+        await local_team.reset()
+        extractors = {}
+        async for event in local_team.run_stream(task=prompt):
+            if first_event_seconds is None and getattr(event, "source", "user") != "user":
+                first_event_seconds = time.perf_counter() - started
+            if isinstance(event, ModelClientStreamingChunkEvent):
+                # 串流輸出時邊收邊解析，persona 一輸出完成就寫入
+                found = extractors.setdefault(event.source, JsonStreamExtractor()).feed(event.content)
+            elif isinstance(event, TextMessage):
+                if event.source != "user":
+                    rounds += 1
+                    if usage is not None:
+                        # 多模型路由時依實際回應的模型統計，不使用 client 的組合名稱
+                        usage.record_message(start_idx, event.source, served_model(event.models_usage, team_pool["model"]), event.models_usage)
+                    if event.models_usage is not None:
+                        emit({"type": "usage", "prompt_tokens": event.models_usage.prompt_tokens, "completion_tokens": event.models_usage.completion_tokens})
+                if echo_messages:
+                    print(f"[{event.source}] => {event.content}\n")
+                messages.append({
+                    "batch_start": start_idx,
+                    "batch_end": end_idx,
+                    "source": event.source,
+                    "content": event.content,
+                    "type": event.type,
+                    "prompt_tokens": event.models_usage.prompt_tokens if event.models_usage else None,
+                    "completion_tokens": event.models_usage.completion_tokens if event.models_usage else None,
+                    "chunk_tokens_saved": encode_stats["tokens_saved"],
+                    "persona_model": served_model(event.models_usage),
+                    "endpoint": served_endpoint(event.models_usage),
+                })
+                # 已串流過的訊息在收到 chunk 時就解析完畢，未經串流的回覆（例如快取命中）在此一次解析
+                # task 本身（source 為 user）含有 JSON 格式範例，不解析
+                found = [] if event.source == "user" or extractors.pop(event.source, None) else JsonStreamExtractor().feed(event.content)
+            elif isinstance(event, TaskResult):
+                stop_reason = event.stop_reason
+                continue
+            else:
+                continue
+            # 先驗證再寫入 sink，不合格的 persona 不會出現在輸出檔與介面上
+            valid, stats = validate_personas(found)
+            if stats["rejected"]:
+                print_validation_stats(stats)
+            personas.extend(valid)
+            for persona in valid:
+                persona_sink.put(persona)
+                emit({"type": "persona", "persona": persona})
+            # 取得有效的 persona 後就結束，不必等其他 agent 輪流發言
+            if valid:
+                stop_signal.set()
+    finally:
+        team_pool["queue"].put_nowait((local_team, stop_signal))
+        if usage is not None:
+            usage.record_chunk(start_idx, time.perf_counter() - started, first_event_seconds, rounds, stop_reason)
+    # 每列對話紀錄都記下本批次停止的原因
+    for row in messages:
+        row["stop_reason"] = stop_reason
+    print("本批次資料處理完成。")
+    return messages, personas
+
+async def run_pipeline(csv_path, build_prompt, persona_sink, md_content=(), system_message=None, resume=False,
+                       incremental=False, output_dir=".", on_event=None, echo_messages=True):
+    """
+    讀取問卷 CSV，逐批產生 persona 後分層合併並驗證，回傳 (對話紀錄路徑, 合併後的 persona)；CSV 無法讀取時回傳 None。
+    build_prompt 產生各批次的 prompt（見 process_chunk）；persona_sink 提供 start、put 與 async close，
+    各批次通過驗證的 persona 產生時就放入（例如 PersonaSink 或 PartialZipPublisher）。
+    system_message 為含 {digest} 與 {research} 的範本時，先以 md_content 產生訪談摘要並搜尋外部資源，
+    填入後作為各 team 共用的 system message。
+    resume=True 時會讀取相同輸入上次中斷留下的 checkpoint 日誌，只重新處理尚未完成的批次；
+    所有批次都成功後日誌即刪除，不會成為下次執行的快取。
+    incremental=True 時只處理新增或內容有變動的批次，其餘沿用上次執行的 persona 再合併輸出。
+    輸出檔案寫入 output_dir；on_event 在執行中回報批次進度、persona 與 token 用量（見 stream_pipeline）。
+    """
+    # 編碼偵測、輸入雜湊與筆數計算在同一次掃描中完成，並在執行緒中執行，不阻塞其他 job 共用的 event loop
+    encoding, input_hash, total_records = await asyncio.to_thread(scan_csv, csv_path, md_content)
+    print(f"檢測到的 CSV 編碼格式: {encoding}")
+
+    try:
+        # 標題列以偵測到的編碼解讀；讀取時預先載入的後段內容若無法解碼，由 read_csv_chunks 逐批處理
+        columns = pd.read_csv(csv_path, nrows=0, encoding=encoding, encoding_errors="replace").columns
+        # 惰性逐批讀取，不把整份問卷先載入記憶體；某一批解碼失敗時只重新解碼該批
+        reader = read_csv_chunks(csv_path, encoding, columns, chunksize=CHUNK_ROWS)
+        print(f"成功開啟 CSV 檔案: {csv_path}")
+    except Exception as e:
+        print(f"無法讀取 CSV 檔案: {e}")
+        return None
+
+    print(f"CSV 總筆數: {total_records}")
+
+    # 完整 team 使用路由的 client，串接模式下固定為大模型；串接模式另建小模型的 client 草擬 persona
+    model_client = build_model_client(full_team_model())
+    draft_client = build_model_client(CASCADE_DRAFT_MODEL) if CASCADE_ENABLED else None
+    try:
+        if system_message is not None:
+            interview_digest = await build_interview_digest(md_content, model_client)
+            research = await research_learning_resources(model_client)
+            system_message = system_message.format(digest=interview_digest, research=research)
+        # 有多把金鑰時，同時執行的 team 數等比例放大（每把金鑰的端點各有自己的每分鐘配額）
+        capacity = max(len(GEMINI_API_KEYS), 1)
+        team_pool = create_team_pool(model_client, system_message, size=MAX_CONCURRENT_TEAMS * capacity, draft_client=draft_client)
+
+        # 讀取 checkpoint 日誌，已完成的批次直接沿用
+        if not resume:
+            await asyncio.to_thread(clear_journal, input_hash)
+        chunk_results = await asyncio.to_thread(load_journal, input_hash)
+        if chunk_results:
+            print(f"從 checkpoint 恢復 {len(chunk_results)} 個已完成的批次")
+
+        # 增量模式：以標題列的欄位識別同一份問卷（有訪談內容時連同訪談內容，沒有時只看欄位），讀取上次各批次的指紋
+        manifest = {}
+        fingerprints = {}
+        reused = []
+        if incremental:
+            survey_key = hashlib.sha256(("\t".join(map(str, columns)) + "\n".join(md_content)).encode("utf-8")).hexdigest()
+            manifest = load_manifest(survey_key)
+
+        # 重新開始輸出，並寫回已完成批次的 persona
+        persona_sink.start()
+        for idx in sorted(chunk_results):
+            for persona in chunk_results[idx][1]:
+                persona_sink.put(persona)
+
+        # 對話紀錄邊處理邊寫入檔案，先寫入已完成批次的紀錄，記憶體中只保留 persona
+        log_path = os.path.join(output_dir, conversation_log_path())
+        log_writer = ConversationLogWriter(log_path)
+        usage_tracker = UsageTracker()
+        for idx in sorted(chunk_results):
+            await asyncio.to_thread(log_writer.write_chunk, chunk_results[idx][0])
+            chunk_results[idx] = ([], chunk_results[idx][1])
+
+        total_chunks = (total_records + CHUNK_ROWS - 1) // CHUNK_ROWS
+
+        def report_progress():
+            if on_event is not None:
+                on_event({"type": "progress", "done": len(chunk_results), "total": total_chunks})
+
+        report_progress()
+
+        write_lock = asyncio.Lock()
+
+        async def run_chunk(idx, chunk):
+            result = await process_chunk(
+                chunk, idx * CHUNK_ROWS, total_records, team_pool, build_prompt, persona_sink,
+                usage=usage_tracker, on_event=on_event, echo_messages=echo_messages,
+            )
+            # checkpoint 日誌的 fsync 與對話紀錄的寫入都在執行緒中進行；以 lock 讓各批次依序寫入同一個檔案
+            async with write_lock:
+                await asyncio.to_thread(append_journal, input_hash, idx, *result)
+                await asyncio.to_thread(log_writer.write_chunk, result[0])
+            chunk_results[idx] = ([], result[1])
+            report_progress()
+            return idx
+
+        # 依批次順序處理尚未完成的批次
+        def iter_jobs():
+            for idx, chunk in enumerate(reader):
+                if incremental:
+                    fingerprints[idx] = chunk_fingerprint(chunk)
+                    previous = manifest.get(str(idx))
+                    if idx not in chunk_results and previous and previous["fingerprint"] == fingerprints[idx]:
+                        chunk_results[idx] = ([], previous["personas"])
+                        reused.append(idx)
+                        for persona in previous["personas"]:
+                            persona_sink.put(persona)
+                if idx in chunk_results:
+                    continue
+                print(f"排程處理第 {idx} 批次資料")
+                yield lambda chunk=chunk, idx=idx: run_chunk(idx, chunk)
+
+        try:
+            results = await run_scheduled(iter_jobs(), max_in_flight=MAX_CONCURRENT_TEAMS * capacity)
+        finally:
+            log_writer.close()
+            usage_tracker.write(os.path.join(output_dir, "usage_summary.csv"), os.path.join(output_dir, "usage_metrics.prom"))
+            await persona_sink.close()
+        if incremental:
+            print(f"增量模式：沿用 {len(reused)} 個未變動的批次，處理 {len(fingerprints) - len(reused)} 個新增或變動的批次")
+            await asyncio.to_thread(save_manifest, survey_key, {
+                str(idx): {"fingerprint": fingerprints[idx], "personas": chunk_results[idx][1]}
+                for idx in chunk_results if idx in fingerprints
+            })
+        print("所有批次處理完成。")
+        print(f"斷路器斷開 {provider_breaker.trips} 次")
+        for client in (model_client, draft_client):
+            if client is None:
+                continue
+            print(f"{client.model} 回應快取命中 {client.hits} 次，未命中 {client.misses} 次，"
+                  f"省下 tokens {client.saved_prompt_tokens}/{client.saved_completion_tokens}")
+            for stat in client.endpoint_stats():
+                latency = f"{stat['latency']:.2f}" if stat["latency"] is not None else "-"
+                print(f"端點 {stat['name']}：呼叫 {stat['calls']} 次，失敗 {stat['failures']} 次，延遲 EWMA {latency} 秒，"
+                      f"tokens {stat['prompt_tokens']}/{stat['completion_tokens']}")
+
+        chunk_personas = []
+        for idx in sorted(chunk_results):
+            batch_personas = [persona for persona in chunk_results[idx][1] if isinstance(persona, dict)]
+            assign_covered_rows(batch_personas, max(min(CHUNK_ROWS, total_records - idx * CHUNK_ROWS), 0))
+            chunk_personas.append(batch_personas)
+
+        # 分層合併各批次的 persona，得到去除重複後的最終 persona 與各自涵蓋的問卷筆數
+        all_personas = await reduce_personas(model_client, chunk_personas)
+        print(f"合併後共 {len(all_personas)} 個 persona")
+
+        # 一次驗證並修正合併後的 persona，缺少的欄位補上預設值
+        all_personas, stats = validate_personas(all_personas, fill_missing=True)
+        print_validation_stats(stats)
+
+        # 所有批次都成功後刪除 checkpoint 日誌：日誌只用來從中斷處繼續，不作為下次執行的快取
+        if None in results:
+            print(f"有 {results.count(None)} 個批次失敗，保留 checkpoint 日誌，可勾選「從上次中斷處繼續」重新處理")
+        else:
+            await asyncio.to_thread(clear_journal, input_hash)
+        return log_path, all_personas
+    finally:
+        # 兩個 client 都在這次執行中建立，無論成功或失敗都在結束時關閉
+        await model_client.close()
+        if draft_client is not None:
+            await draft_client.close()
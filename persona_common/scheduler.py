@@ -0,0 +1,58 @@
+"""
+批次工作的排程器：限制同時執行的數量，並在斷路器斷開時暫停放行。
+"""
+import asyncio
+
+from .llm import provider_breaker
+
+# 併發控制設定：同時執行的 team 數量上限（每分鐘請求與 token 配額由 RoutedChatCompletionClient 在每次呼叫時控管）
+MAX_CONCURRENT_TEAMS = 4
+
+async def run_scheduled(jobs, max_in_flight=MAX_CONCURRENT_TEAMS, breaker=provider_breaker):
+    """
+    以有限的併發數執行批次工作，取代一次全部丟進 asyncio.gather。
+    jobs: 可迭代的 job_factory，呼叫後回傳 coroutine，依 jobs 的順序放行。
+          jobs 可以是惰性產生器：會在背景執行緒逐一取出，佇列最多只暫存 max_in_flight 筆，
+          第一個批次不必等整份檔案讀完就會開始處理。
+    斷路器斷開（模型服務持續失敗）時暫停放行新的批次，直到冷卻結束。
+    回傳與 jobs 相同順序的結果列表；失敗的批次為 None，其餘批次結果照常保留。
+    讀取 jobs 本身失敗（例如 CSV 解析錯誤）時，等已放行的批次完成後拋出該例外。
+    """
+    queue = asyncio.Queue(maxsize=max_in_flight)
+    results = {}
+    produced = [0]
+    producer_error = []
+
+    async def producer():
+        iterator = iter(jobs)
+        try:
+            while True:
+                job_factory = await asyncio.to_thread(next, iterator, None)
+                if job_factory is None:
+                    break
+                await queue.put((produced[0], job_factory))
+                produced[0] += 1
+        except Exception as e:
+            # 已讀取的批次照常處理完（結果會寫入 checkpoint），之後再把錯誤拋給呼叫端，job 會標記為失敗
+            print(f"讀取第 {produced[0]} 批次時失敗，處理完已讀取的批次後中止: {e}")
+            producer_error.append(e)
+        finally:
+            # 每個 worker 放一個結束標記，排在所有工作之後
+            for _ in range(max_in_flight):
+                await queue.put((None, None))
+
+    async def worker():
+        while True:
+            order, job_factory = await queue.get()
+            if job_factory is None:
+                return
+            await breaker.wait_until_closed()
+            try:
+                results[order] = await job_factory()
+            except Exception as e:
+                print(f"第 {order} 批次處理失敗，保留其餘批次結果: {e}")
+
+    await asyncio.gather(producer(), *(worker() for _ in range(max_in_flight)))
+    if producer_error:
+        raise producer_error[0]
+    return [results.get(order) for order in range(produced[0])]
@@ -0,0 +1,108 @@
+"""
+產生 persona 的 agent team：終止條件、team pool，以及先以小模型草擬的串接模式。
+"""
+import os
+import asyncio
+
+from autogen_agentchat.agents import AssistantAgent
+from autogen_agentchat.conditions import (
+    ExternalTermination, MaxMessageTermination, TextMentionTermination, TimeoutTermination, TokenUsageTermination,
+)
+from autogen_agentchat.teams import RoundRobinGroupChat
+from autogen_core.models import SystemMessage, UserMessage
+
+from .llm import DEFAULT_GEMINI_MODEL
+from .personas import JsonStreamExtractor, validate_personas
+from .scheduler import MAX_CONCURRENT_TEAMS
+
+# team 的終止上限：訊息數、token 數與執行秒數，避免沒有 agent 說 TERMINATE 時無限輪流發言
+TEAM_MAX_MESSAGES = 12
+TEAM_MAX_TOKENS = 200000
+TEAM_TIMEOUT_SECONDS = 300
+
+def build_termination():
+    """
+    組合 team 的終止條件，任一條件成立即停止：說出 TERMINATE、達到訊息數或 token 上限、執行逾時，
+    或外部訊號被觸發。回傳 (終止條件, 外部訊號)，取得有效 persona 後呼叫外部訊號的 set() 提早結束。
+    """
+    stop_signal = ExternalTermination()
+    termination = (
+        TextMentionTermination("TERMINATE")
+        | MaxMessageTermination(TEAM_MAX_MESSAGES)
+        | TokenUsageTermination(max_total_token=TEAM_MAX_TOKENS)
+        | TimeoutTermination(TEAM_TIMEOUT_SECONDS)
+        | stop_signal
+    )
+    return termination, stop_signal
+
+def create_team_pool(model_client, system_message=None, size=MAX_CONCURRENT_TEAMS, draft_client=None):
+    """
+    預先建立固定數量的 team，各批次輪流借用，用完重置狀態後歸還，
+    不必每個批次都重新建立 agent。
+    system_message 為各批次共用的背景資料（例如訪談摘要與外部資源），放在 data_agent 與 report_generator 的系統訊息；
+    未指定時使用 AssistantAgent 預設的系統訊息。
+    每個 team 有自己的終止條件與外部終止訊號，避免同時執行的 team 互相影響，
+    佇列中的元素為 (team, 外部終止訊號)。
+    指定 draft_client 時啟用串接模式，各批次先由該 client 草擬 persona。
+    """
+    pool = {
+        "queue": asyncio.Queue(),
+        "model": model_client.model,
+        "draft_client": draft_client,
+        "draft_model": draft_client.model if draft_client is not None else None,
+        "system_message": system_message,
+    }
+    shared = {"system_message": system_message} if system_message else {}
+    for _ in range(size):
+        termination, stop_signal = build_termination()
+        assistant_1 = AssistantAgent("data_agent", model_client, model_client_stream=True, **shared)
+        assistant_2 = AssistantAgent("assistant", model_client, model_client_stream=True)
+        report_generator = AssistantAgent("report_generator", model_client, model_client_stream=True, **shared)
+        team = RoundRobinGroupChat(
+            [assistant_1, assistant_2, report_generator],
+            termination_condition=termination,
+        )
+        pool["queue"].put_nowait((team, stop_signal))
+    return pool
+
+# 串接模式（PERSONA_CASCADE=1 開啟）：先由小模型單次呼叫草擬 persona，草稿未通過 schema 驗證或信心檢查時才動用完整 team
+# 完整 team 固定使用大模型（PERSONA_FULL_MODEL，預設 gemini-2.0-flash），只在各把金鑰間分配，
+# 不與草稿模型混用，草稿沒通過的批次不會再送回小模型
+CASCADE_ENABLED = os.environ.get("PERSONA_CASCADE", "0") == "1"
+CASCADE_DRAFT_MODEL = os.environ.get("PERSONA_DRAFT_MODEL", "gemini-1.5-flash-8b")
+CASCADE_FULL_MODEL = os.environ.get("PERSONA_FULL_MODEL") or DEFAULT_GEMINI_MODEL
+# 信心檢查：這些欄位少於此字數時視為草稿內容過於空泛
+CASCADE_CONFIDENCE_FIELDS = ("description", "motivation", "challenges", "learning_goals")
+CASCADE_MIN_TEXT_CHARS = 12
+
+def full_team_model():
+    """
+    完整 team 的 client 使用的模型，交給 build_model_client：串接模式下為 CASCADE_FULL_MODEL，
+    未開啟串接模式時為 None（使用 GEMINI_MODELS）。
+    """
+    if not CASCADE_ENABLED:
+        return None
+    if CASCADE_FULL_MODEL == CASCADE_DRAFT_MODEL:
+        print(f"PERSONA_FULL_MODEL 與草稿模型同為 {CASCADE_DRAFT_MODEL}，草稿未通過的批次仍會由同一個模型處理")
+    return CASCADE_FULL_MODEL
+
+async def draft_personas(team_pool, prompt):
+    """
+    以小模型草擬本批次的 persona，回傳 (模型回覆, 通過驗證的 persona, 是否可直接採用)。
+    草稿呼叫失敗時模型回覆為 None，交由完整 team 處理。
+    """
+    request = [UserMessage(content=prompt, source="user")]
+    if team_pool.get("system_message"):
+        request.insert(0, SystemMessage(content=team_pool["system_message"]))
+    try:
+        response = await team_pool["draft_client"].create(request)
+    except Exception as e:
+        print(f"草稿模型呼叫失敗，改由完整 team 處理: {e}")
+        return None, [], False
+    valid, stats = validate_personas(JsonStreamExtractor().feed(response.content))
+    confident = bool(valid) and not stats["rejected"] and all(
+        len(persona[field]) >= CASCADE_MIN_TEXT_CHARS
+        for persona in valid
+        for field in CASCADE_CONFIDENCE_FIELDS
+    )
+    return response, valid, confident
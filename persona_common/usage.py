@@ -0,0 +1,113 @@
+"""
+token 用量、費用與耗時的統計。
+"""
+import collections
+
+import pandas as pd
+
+# 各模型每百萬 token 的價格（美元）：(輸入, 輸出)
+MODEL_PRICES = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-1.5-flash-8b": (0.0375, 0.15),
+}
+
+class UsageTracker:
+    """
+    統計每個批次、agent 與模型的 token 用量、費用與耗時。
+    process_chunk 在收到帶有 models_usage 的訊息時呼叫 record_message，批次結束時呼叫 record_chunk；
+    命中回應快取（cached=True）的訊息只計入 cached_messages，不計入實際的 token 用量與費用；
+    最後可輸出成摘要表（CSV）或 Prometheus 文字格式。
+    """
+
+    def __init__(self, prices=MODEL_PRICES):
+        self.prices = prices
+        # (batch_start, source, model) -> 訊息數與 token 數
+        self.agents = collections.defaultdict(lambda: {"messages": 0, "cached_messages": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        # batch_start -> 批次耗時、第一個模型事件的等待時間、回合數
+        self.chunks = {}
+
+    def cost(self, model, prompt_tokens, completion_tokens):
+        # 一般以實際回應的模型計價；無法得知實際模型而記為組合名稱（例如 "gemini-2.0-flash+gemini-1.5-flash-8b"）時，以其中最貴的模型估算上限
+        prices = [self.prices.get(name, (0.0, 0.0)) for name in model.split("+")]
+        price_in, price_out = max(price for price, _ in prices), max(price for _, price in prices)
+        return (prompt_tokens * price_in + completion_tokens * price_out) / 1_000_000
+
+    def record_message(self, batch_start, source, model, usage, cached=False):
+        stats = self.agents[(batch_start, source, model)]
+        stats["messages"] += 1
+        if cached:
+            stats["cached_messages"] += 1
+        elif usage is not None:
+            stats["prompt_tokens"] += usage.prompt_tokens
+            stats["completion_tokens"] += usage.completion_tokens
+
+    def record_chunk(self, batch_start, wall_seconds, first_event_seconds, rounds, stop_reason=None):
+        self.chunks[batch_start] = {
+            "wall_seconds": wall_seconds,
+            "first_event_seconds": first_event_seconds,
+            "rounds": rounds,
+            "stop_reason": stop_reason,
+        }
+
+    def summary(self):
+        """每個批次 × agent × 模型一列，附上該批次的耗時與回合數"""
+        rows = []
+        for (batch_start, source, model), stats in sorted(self.agents.items(), key=lambda item: (item[0][0], item[0][1])):
+            chunk = self.chunks.get(batch_start, {})
+            rows.append({
+                "batch_start": batch_start,
+                "source": source,
+                "model": model,
+                **stats,
+                "cost_usd": self.cost(model, stats["prompt_tokens"], stats["completion_tokens"]),
+                "chunk_wall_seconds": chunk.get("wall_seconds"),
+                "chunk_first_event_seconds": chunk.get("first_event_seconds"),
+                "chunk_rounds": chunk.get("rounds"),
+                "chunk_stop_reason": chunk.get("stop_reason"),
+            })
+        return pd.DataFrame(rows, columns=[
+            "batch_start", "source", "model", "messages", "cached_messages", "prompt_tokens", "completion_tokens", "cost_usd",
+            "chunk_wall_seconds", "chunk_first_event_seconds", "chunk_rounds", "chunk_stop_reason",
+        ])
+
+    def prometheus_text(self):
+        """以 Prometheus 文字格式輸出各 agent 的累計用量與批次耗時"""
+        totals = collections.defaultdict(lambda: [0, 0, 0])
+        for (_, source, model), stats in self.agents.items():
+            total = totals[(source, model)]
+            total[0] += stats["messages"]
+            total[1] += stats["prompt_tokens"]
+            total[2] += stats["completion_tokens"]
+        # 同一個 metric 的所有樣本需連續輸出
+        items = sorted(totals.items())
+        lines = ["# TYPE persona_agent_messages_total counter"]
+        for (source, model), (messages, _, _) in items:
+            lines.append(f'persona_agent_messages_total{{agent="{source}",model="{model}"}} {messages}')
+        lines.append("# TYPE persona_agent_tokens_total counter")
+        for (source, model), (_, prompt_tokens, completion_tokens) in items:
+            lines.append(f'persona_agent_tokens_total{{agent="{source}",model="{model}",direction="prompt"}} {prompt_tokens}')
+            lines.append(f'persona_agent_tokens_total{{agent="{source}",model="{model}",direction="completion"}} {completion_tokens}')
+        lines.append("# TYPE persona_agent_cost_usd_total counter")
+        for (source, model), (_, prompt_tokens, completion_tokens) in items:
+            cost = self.cost(model, prompt_tokens, completion_tokens)
+            lines.append(f'persona_agent_cost_usd_total{{agent="{source}",model="{model}"}} {cost:.6f}')
+        chunks = list(self.chunks.values())
+        for name in ("wall_seconds", "first_event_seconds", "rounds"):
+            values = [chunk[name] for chunk in chunks if chunk[name] is not None]
+            lines.append(f"# TYPE persona_chunk_{name} summary")
+            lines.append(f"persona_chunk_{name}_sum {sum(values):.3f}")
+            lines.append(f"persona_chunk_{name}_count {len(values)}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, summary_path="usage_summary.csv", metrics_path="usage_metrics.prom"):
+        """輸出摘要表與 Prometheus 文字檔，並印出各 agent 的用量"""
+        df = self.summary()
+        df.to_csv(summary_path, index=False, encoding="utf-8-sig")
+        with open(metrics_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        if not df.empty:
+            by_agent = df.groupby(["source", "model"])[["prompt_tokens", "completion_tokens", "cost_usd"]].sum()
+            print("各 agent 的 token 用量與費用：")
+            print(by_agent.to_string())
+        print(f"用量統計已輸出至 {summary_path}、{metrics_path}")
+        return summary_path, metrics_path
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# 測試使用獨立的快取目錄，須在載入 persona_common 之前設定
+os.environ["PERSONA_CACHE_DIR"] = tempfile.mkdtemp(prefix="persona_cache_test_")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
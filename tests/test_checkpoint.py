@@ -0,0 +1,18 @@
+import os
+
+from persona_common import checkpoint
+
+
+def test_journal_resumes_finished_chunks_and_skips_torn_line():
+    input_hash = "journal-test"
+    checkpoint.clear_journal(input_hash)
+    checkpoint.append_journal(input_hash, 0, [{"source": "data_agent"}], [{"persona_id": "1"}])
+    checkpoint.append_journal(input_hash, 2, [], [{"persona_id": "2"}])
+    # 模擬寫到一半就中斷的最後一行
+    with open(os.path.join(checkpoint.JOURNAL_DIR, f"{input_hash}.jsonl"), "a", encoding="utf-8") as f:
+        f.write('{"input_hash": "journal-test", "chunk": 3, "mess')
+    finished = checkpoint.load_journal(input_hash)
+    assert sorted(finished) == [0, 2]
+    assert finished[2] == ([], [{"persona_id": "2"}])
+    checkpoint.clear_journal(input_hash)
+    assert checkpoint.load_journal(input_hash) == {}
@@ -0,0 +1,55 @@
+import io
+
+import pandas as pd
+
+from persona_common.encoders import encode_chunk, encode_coded, encode_tsv
+from persona_common.llm import estimate_tokens
+
+QUESTIONS = ["您學習泰文的主要動機是什麼？", "您每週可以投入多少時間學習？", "備註"]
+
+
+def survey_chunk():
+    return pd.DataFrame({
+        QUESTIONS[0]: ["想去泰國自助旅行並和當地人聊天"] * 3 + ["工作需要"],
+        QUESTIONS[1]: ["一到三小時", "一到三小時", "三小時以上", "一到三小時"],
+        QUESTIONS[2]: [None] * 4,
+    })
+
+
+def test_tsv_lists_each_question_once_and_drops_empty_columns():
+    text = encode_tsv(survey_chunk())
+    assert text.count(QUESTIONS[0]) == 1
+    assert "c1=" + QUESTIONS[0] in text
+    assert QUESTIONS[2] not in text
+    body = text.split("資料(TSV):\n", 1)[1]
+    assert list(pd.read_csv(io.StringIO(body), sep="\t").columns) == ["c1", "c2"]
+
+
+def test_coded_answers_round_trip_through_the_code_table():
+    chunk = survey_chunk()
+    text = encode_coded(chunk)
+    tables, body = text.split("答案代碼表:\n", 1)[1].split("\n資料(TSV):\n", 1)
+    mapping = {}
+    for line in tables.splitlines():
+        for pair in line.split(": ", 1)[1].split(" | "):
+            code, value = pair.split("=", 1)
+            mapping[code] = value
+    # 只有重複出現的長答案換成代碼，只出現一次的答案保留原文
+    assert "工作需要" not in mapping.values()
+    assert "三小時以上" not in mapping.values()
+    decoded = pd.read_csv(io.StringIO(body), sep="\t").replace(mapping)
+    assert decoded["c1"].tolist() == chunk[QUESTIONS[0]].tolist()
+    assert decoded["c2"].tolist() == chunk[QUESTIONS[1]].tolist()
+
+
+def test_encode_chunk_reports_tokens_saved_against_records():
+    chunk = survey_chunk()
+    text, stats = encode_chunk(chunk, "coded")
+    assert stats["encoder"] == "coded"
+    assert stats["encoded_tokens"] == estimate_tokens(text)
+    assert stats["tokens_saved"] == stats["baseline_tokens"] - stats["encoded_tokens"]
+    assert stats["tokens_saved"] > 0
+
+    _, records_stats = encode_chunk(chunk, "records")
+    assert records_stats["baseline_tokens"] == stats["baseline_tokens"]
+    assert records_stats["tokens_saved"] == 0
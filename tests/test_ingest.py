@@ -0,0 +1,88 @@
+import hashlib
+
+import pandas as pd
+
+from persona_common import ingest
+from persona_common.ingest import decode_block, read_csv_chunks, scan_csv
+
+
+def write_csv(tmp_path, data, name="survey.csv"):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_scan_csv_utf8_with_bom(tmp_path):
+    path = write_csv(tmp_path, "\ufeff姓名,回答\n小明,想學泰文\n".encode("utf-8"))
+    assert scan_csv(path)[0] == "utf-8-sig"
+
+
+def test_scan_csv_big5_family(tmp_path):
+    path = write_csv(tmp_path, "姓名,回答\n小明,想學泰文\n".encode("cp950"))
+    assert scan_csv(path)[0] == "cp950"
+
+
+def test_scan_csv_mixed_file_stays_on_candidates_and_is_not_cached(tmp_path, monkeypatch):
+    data = "姓名,回答\n".encode("utf-8") + "小華,旅遊會用到\n".encode("cp950")
+    path = write_csv(tmp_path, data)
+    monkeypatch.setattr(ingest.chardet, "detect", lambda sample: {"encoding": "IBM866"})
+    assert scan_csv(path)[0] == "utf-8"
+    assert hashlib.blake2b(data, digest_size=16).hexdigest() not in ingest.load_encoding_cache()
+
+
+def test_scan_csv_reuses_cached_encoding_without_decoding(tmp_path, monkeypatch):
+    data = "姓名,回答\n小明,想學泰文\n".encode("utf-8")
+    path = write_csv(tmp_path, data)
+    assert scan_csv(path)[0] == "utf-8"
+    assert ingest.load_encoding_cache()[hashlib.blake2b(data, digest_size=16).hexdigest()] == "utf-8"
+
+    def fail(data, encoding):
+        raise AssertionError("命中快取時不應重新驗證編碼")
+
+    monkeypatch.setattr(ingest, "validate_encoding", fail)
+    assert scan_csv(path)[0] == "utf-8"
+
+
+def test_decode_block_falls_back_per_line():
+    block = "小明,想學泰文\n".encode("utf-8") + "小華,旅遊會用到\n".encode("cp950")
+    text, used = decode_block(block, "utf-8")
+    assert text == "小明,想學泰文\n小華,旅遊會用到\n"
+    assert used != "utf-8"
+
+
+def test_scan_csv_counts_rows_across_blocks_and_quoted_newlines(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, "ENCODING_VALIDATE_BLOCK", 7)
+    path = write_csv(tmp_path, '姓名,回答\n小明,"第一行\n第二行"\n\n小華,好\n'.encode("cp950"))
+    assert scan_csv(path)[2] == 2
+
+
+def test_scan_csv_falls_back_on_stray_quote(tmp_path):
+    path = write_csv(tmp_path, '姓名,回答\n小明,他說"好\n小華,好\n小美,"引號\n內換行"\n'.encode("utf-8"))
+    assert scan_csv(path)[2] == 3
+
+
+def test_scan_csv_input_hash_covers_csv_and_interviews(tmp_path):
+    data = "姓名,回答\n小明,好\n".encode("utf-8")
+    path = write_csv(tmp_path, data)
+    assert scan_csv(path, ["# 訪談"])[1] == hashlib.sha256(data + "# 訪談".encode("utf-8")).hexdigest()
+    assert scan_csv(path, ["# 另一份訪談"])[1] != scan_csv(path, ["# 訪談"])[1]
+
+
+def test_read_csv_chunks_splits_rows_with_stray_quote(tmp_path):
+    rows = ["姓名,回答\n"] + [f'u{i},他說"好{i}\n' for i in range(5)]
+    path = write_csv(tmp_path, "".join(rows).encode("utf-8"))
+    columns = pd.read_csv(path, nrows=0).columns
+    chunks = list(read_csv_chunks(path, "utf-8", columns, chunksize=2))
+    assert [list(chunk.index) for chunk in chunks] == [[0, 1], [2, 3], [4]]
+    assert chunks[2]["回答"].iloc[0] == '他說"好4'
+
+
+def test_read_csv_chunks_keeps_index_and_redecodes_chunk(tmp_path):
+    rows = ["姓名,回答\n".encode("utf-8")]
+    rows += [f"u{i},回答{i}\n".encode("utf-8") for i in range(3)]
+    rows += [f"b{i},回答{i}\n".encode("cp950") for i in range(3)]
+    path = write_csv(tmp_path, b"".join(rows))
+    columns = pd.read_csv(path, nrows=0, encoding="utf-8", encoding_errors="replace").columns
+    chunks = list(read_csv_chunks(path, "utf-8", columns, chunksize=3))
+    assert [list(chunk.index) for chunk in chunks] == [[0, 1, 2], [3, 4, 5]]
+    assert list(chunks[1]["回答"]) == ["回答0", "回答1", "回答2"]
@@ -0,0 +1,115 @@
+import asyncio
+import shutil
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from persona_common import jobs
+from persona_common.jobs import JobManager, estimate_job_eta, format_job_status, persona_preview, stream_pipeline
+
+
+def test_snapshot_is_safe_while_the_job_loop_appends_personas(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_PREVIEW_PERSONAS", 5)
+    manager = JobManager(workers=1)
+    job = manager.create()
+    done = threading.Event()
+
+    def produce():
+        for i in range(3000):
+            with manager._lock:
+                manager._apply(job, {"type": "persona", "batch_start": 0, "persona": {"persona_id": str(i)}})
+        done.set()
+
+    manager._loop.call_soon_threadsafe(produce)
+    # 背景執行緒持續新增 persona 時，介面端反覆讀取快照不會因 deque 被修改而失敗
+    while not done.is_set():
+        persona_preview(manager.get(job["id"]))
+    snapshot = manager.get(job["id"])
+    assert len(persona_preview(snapshot)) == 5
+    # 總數不受預覽的上限影響
+    assert "已產生 3000 個 persona" in format_job_status(snapshot)
+
+
+def test_stream_pipeline_yields_events_then_outputs_and_reraises():
+    async def run(on_event, output_dir=None):
+        on_event({"type": "progress", "done": 0, "total": 2})
+        await asyncio.sleep(0)
+        on_event({"type": "persona", "batch_start": 0, "persona": {"persona_id": "1"}})
+        return "log.csv", output_dir
+
+    async def broken(on_event):
+        on_event({"type": "progress", "done": 0, "total": 1})
+        raise ValueError("CSV 解析失敗")
+
+    async def collect(*args, **kwargs):
+        return [event async for event in stream_pipeline(*args, **kwargs)]
+
+    events = asyncio.run(collect(run, output_dir="out"))
+    assert [event["type"] for event in events] == ["progress", "persona", "done"]
+    assert events[-1]["outputs"] == ("log.csv", "out")
+    with pytest.raises(ValueError):
+        asyncio.run(collect(broken))
+
+
+def wait_finished(manager, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = manager.get(job_id)
+        if job["finished"]:
+            return job
+        time.sleep(0.01)
+    raise AssertionError("job 沒有在時間內結束")
+
+
+def test_job_manager_tracks_progress_and_failures():
+    manager = JobManager(workers=1)
+
+    async def run(resumed, output_dir, on_event):
+        # 從 checkpoint 恢復的批次算在 initial_done，不計入本次執行的速度
+        on_event({"type": "progress", "done": resumed, "total": 4})
+        for done in range(resumed + 1, 5):
+            on_event({"type": "usage", "batch_start": done, "prompt_tokens": 100, "completion_tokens": None})
+            on_event({"type": "progress", "done": done, "total": 4})
+        return "log.csv", "persona.txt"
+
+    async def unreadable(output_dir, on_event):
+        return None, None
+
+    async def broken(output_dir, on_event):
+        raise RuntimeError("端點無法連線")
+
+    jobs_created = []
+    for target, args in ((run, (1,)), (unreadable, ()), (broken, ())):
+        job = manager.create()
+        jobs_created.append(job)
+        manager.start(job, target, *args)
+    try:
+        done, unread, failed = (wait_finished(manager, job["id"]) for job in jobs_created)
+        assert done["status"] == "done"
+        assert done["initial_done"] == 1
+        assert (done["done_chunks"], done["total_chunks"]) == (4, 4)
+        assert (done["prompt_tokens"], done["completion_tokens"]) == (300, 0)
+        assert done["outputs"] == ("log.csv", "persona.txt")
+        assert unread["status"] == "failed" and unread["error"] == "無法讀取輸入檔案"
+        assert failed["status"] == "failed"
+        assert "RuntimeError: 端點無法連線" in format_job_status(failed)
+    finally:
+        for job in jobs_created:
+            shutil.rmtree(job["dir"], ignore_errors=True)
+
+
+def test_eta_uses_only_chunks_processed_in_this_run(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(jobs, "time", SimpleNamespace(time=lambda: now))
+    job = {
+        "id": "abc", "status": "running", "started": now - 60, "finished": None, "error": None,
+        "done_chunks": 5, "total_chunks": 10, "initial_done": 2,
+        "prompt_tokens": 0, "completion_tokens": 0, "persona_count": 0,
+    }
+    # 本次執行 60 秒完成 3 個批次，剩下 5 個批次約需 100 秒
+    assert estimate_job_eta(job) == pytest.approx(100)
+    assert "預估剩餘 100 秒" in format_job_status(job)
+    assert estimate_job_eta(dict(job, done_chunks=2)) is None
+    assert estimate_job_eta(dict(job, status="done")) is None
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from autogen_core.models import CreateResult, RequestUsage
+
+from persona_common.llm import CircuitBreaker, ResilientChatCompletionClient
+
+
+class SlowFirstStreamClient:
+    """第一個串流很久才有內容，之後開啟的串流立即回應"""
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+
+    async def create_stream(self, messages, **kwargs):
+        self.opened += 1
+        delay = 5 if self.opened == 1 else 0
+        try:
+            await asyncio.sleep(delay)
+            yield f"chunk-{self.opened}"
+            yield CreateResult(finish_reason="stop", content="ok", usage=RequestUsage(prompt_tokens=1, completion_tokens=1), cached=False)
+        finally:
+            self.closed += 1
+
+
+async def collect(client):
+    return [item async for item in client.create_stream([])]
+
+
+def test_stream_hedging_is_off_by_default():
+    inner = SlowFirstStreamClient()
+    client = ResilientChatCompletionClient(inner, breaker=CircuitBreaker(), hedge_after=0)
+
+    async def main():
+        return await asyncio.wait_for(collect(client), timeout=0.2)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(main())
+    assert inner.opened == 1
+
+
+def test_stream_hedging_uses_the_first_stream_with_content():
+    inner = SlowFirstStreamClient()
+    client = ResilientChatCompletionClient(inner, breaker=CircuitBreaker(), hedge_after=0.05)
+    items = asyncio.run(collect(client))
+    assert items[0] == "chunk-2"
+    assert isinstance(items[-1], CreateResult)
+    assert (inner.opened, inner.closed, client.hedges) == (2, 2, 1)
@@ -0,0 +1,50 @@
+import pytest
+
+from persona_common.logs import LOG_COLUMNS, ConversationLogWriter, conversation_log_path, read_log
+
+
+def chunk_rows(batch_start):
+    return [
+        {"batch_start": batch_start, "batch_end": batch_start + 999, "source": "user", "content": "問卷資料",
+         "type": "TextMessage", "prompt_tokens": None, "completion_tokens": float("nan")},
+        {"batch_start": batch_start, "batch_end": batch_start + 999, "source": "data_agent", "content": '{"persona_id": "1"}',
+         "type": "TextMessage", "prompt_tokens": 120.0, "completion_tokens": 30, "persona_model": "gemini-2.0-flash",
+         "endpoint": "gemini-2.0-flash#1", "extra": "不在欄位中"},
+    ]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl", "parquet"])
+def test_log_writer_round_trips_and_filters(tmp_path, fmt):
+    if fmt == "parquet":
+        pytest.importorskip("pyarrow")
+    path = str(tmp_path / conversation_log_path(fmt))
+    writer = ConversationLogWriter(path, fmt=fmt)
+    writer.write_chunk(chunk_rows(0))
+    writer.write_chunk([])
+    writer.write_chunk(chunk_rows(1000))
+    writer.close()
+    assert writer.rows == 4
+
+    log = read_log(path)
+    assert list(log.columns) == list(LOG_COLUMNS)
+    assert log["batch_start"].tolist() == [0, 0, 1000, 1000]
+
+    replies = read_log(path, batch_start=1000, source="data_agent", columns=["content", "prompt_tokens", "endpoint"])
+    assert len(replies) == 1
+    assert replies.iloc[0]["content"] == '{"persona_id": "1"}'
+    assert replies.iloc[0]["prompt_tokens"] == 120
+    assert replies.iloc[0]["endpoint"] == "gemini-2.0-flash#1"
+
+
+def test_parquet_log_writes_one_row_group_per_chunk(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / conversation_log_path("parquet"))
+    writer = ConversationLogWriter(path, fmt="parquet")
+    for batch_start in (0, 1000, 2000):
+        writer.write_chunk(chunk_rows(batch_start))
+    writer.close()
+    metadata = pq.ParquetFile(path).metadata
+    assert metadata.num_row_groups == 3
+    # 空值保留為 null，不會變成字串 "nan"
+    table = pq.read_table(path, columns=["completion_tokens"])
+    assert table.column("completion_tokens").null_count == 3
@@ -0,0 +1,41 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from persona_common.merge import merge_persona_group
+
+
+class FakeClient:
+    def __init__(self, reply):
+        self.reply = reply
+        self.prompts = []
+
+    async def create(self, messages):
+        self.prompts.append(messages[0].content)
+        return SimpleNamespace(content=self.reply)
+
+
+def persona(pid, rows):
+    return {"persona_id": pid, "description": f"學習者 {pid}", "covered_rows": rows}
+
+
+def test_merge_sums_covered_rows_from_sources_not_model():
+    group = [[persona("A", 400), persona("B", 600)], [persona("A", 300)]]
+    reply = json.dumps([
+        {"persona_id": "1", "description": "合併", "merged_from": [0, 2], "covered_rows": 9999},
+        {"persona_id": "2", "description": "重複引用", "merged_from": [2]},
+    ])
+    client = FakeClient(reply)
+    merged = asyncio.run(merge_persona_group(client, group))
+    assert "covered_rows" not in client.prompts[0]
+    # 模型自行填的 9999 不採用；重複引用的來源只計一次；沒被引用的 B 原樣保留
+    assert [(p["persona_id"], p["covered_rows"]) for p in merged] == [("1", 700), ("2", 0), ("B", 600)]
+    assert sum(p["covered_rows"] for p in merged) == 1300
+    assert all("merged_from" not in p for p in merged)
+
+
+def test_merge_without_sources_keeps_originals():
+    group = [[persona("A", 400)], [persona("B", 600)]]
+    client = FakeClient(json.dumps([{"persona_id": "1", "description": "合併", "covered_rows": 1000}]))
+    merged = asyncio.run(merge_persona_group(client, group))
+    assert merged == [persona("A", 400), persona("B", 600)]
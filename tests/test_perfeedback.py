@@ -0,0 +1,82 @@
+import asyncio
+import importlib.util
+import os
+from types import SimpleNamespace
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "week8rec", "record", "proj_perfeedbacktest.py")
+
+
+@pytest.fixture(scope="module")
+def perfeedback():
+    spec = importlib.util.spec_from_file_location("proj_perfeedbacktest", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeEvalClient:
+    """依文案回覆固定的評估結果，並記錄同時進行中的請求數"""
+
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+        self.closed = False
+
+    async def create(self, messages):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            prompt = messages[0].content
+            if "壞掉的文案" in prompt:
+                raise RuntimeError("端點無法連線")
+            if "看不懂的文案" in prompt:
+                content = "我覺得還不錯"
+            else:
+                content = '好的：{"score": 12, "reasons_for": " 適合旅遊 ", "reasons_against": "價格"}'
+            return SimpleNamespace(content=content, usage=SimpleNamespace(prompt_tokens=50, completion_tokens=10))
+        finally:
+            self.running -= 1
+
+    async def close(self):
+        self.closed = True
+
+
+def test_evaluate_batch_limits_concurrency_and_records_errors(perfeedback):
+    personas = [(f"PERSONA-{i}", {"persona_id": str(i)}) for i in range(4)]
+    copies = [("copy_1", "三個月學會泰文會話"), ("copy_2", "壞掉的文案"), ("copy_3", "看不懂的文案")]
+    client = FakeEvalClient()
+    results = asyncio.run(perfeedback.evaluate_batch(personas, copies, model_client=client, max_concurrency=3))
+
+    assert list(results.columns) == perfeedback.EVAL_COLUMNS
+    assert len(results) == 12
+    assert client.peak == 3
+    # 傳入的 client 由呼叫端負責關閉
+    assert not client.closed
+
+    by_copy = {name: rows for name, rows in results.groupby("copy")}
+    good = by_copy["copy_1"]
+    assert good["score"].tolist() == [10] * 4
+    assert good["reasons_for"].tolist() == ["適合旅遊"] * 4
+    assert good["error"].isna().all()
+    assert by_copy["copy_2"]["error"].str.contains("RuntimeError").all()
+    assert by_copy["copy_3"]["error"].eq("無法解析模型回覆").all()
+
+    matrix = perfeedback.score_matrix(results)
+    assert matrix.loc["平均", "copy_1"] == 10
+
+
+def test_evaluate_batch_closes_the_client_it_builds(perfeedback, monkeypatch):
+    built = []
+
+    def build_model_client(model):
+        built.append((model, FakeEvalClient()))
+        return built[-1][1]
+
+    monkeypatch.setattr(perfeedback, "build_model_client", build_model_client)
+    results = asyncio.run(perfeedback.evaluate_batch([("PERSONA-1", {})], [("copy_1", "文案")]))
+    assert len(results) == 1
+    assert built[0][0] == perfeedback.EVAL_MODEL
+    assert built[0][1].closed
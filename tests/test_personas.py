@@ -0,0 +1,136 @@
+import asyncio
+import glob
+import gzip
+import json
+import os
+import zipfile
+
+from persona_common.personas import (
+    JsonStreamExtractor, PartialZipPublisher, PersonaSink, PersonaZipWriter, publish_persona_zip, validate_personas,
+)
+
+PERSONA = (
+    '{"persona_id": 1, "description": "上班族", "motivation": "旅遊", "challenges": "沒時間", '
+    '"learning_goals": "日常會話", "preferred_learning_methods": "線上課程", '
+    '"suggested_learning_resources": [{"feature_name": "App", "description": "每日練習", "justification": "零碎時間"}]}'
+)
+
+
+def test_extractor_emits_each_object_as_soon_as_it_closes():
+    text = f"以下是結果：```json\n[{PERSONA}, {PERSONA}]\n```"
+    extractor = JsonStreamExtractor()
+    found = []
+    for i in range(0, len(text), 7):
+        found.extend(extractor.feed(text[i:i + 7]))
+    assert len(found) == 2
+    assert found[0]["description"] == "上班族"
+
+
+def test_extractor_ignores_braces_inside_strings():
+    found = JsonStreamExtractor().feed('{"description": "用 } 與 { 舉例", "motivation": "x"}')
+    assert found == [{"description": "用 } 與 { 舉例", "motivation": "x"}]
+
+
+def test_validate_personas_rejects_placeholders():
+    template = PERSONA.replace("上班族", "...")
+    valid, stats = validate_personas(JsonStreamExtractor().feed(f"[{PERSONA}, {template}]"))
+    assert len(valid) == 1
+    assert valid[0]["persona_id"] == "1"
+    assert stats["rejected"] == 1
+    assert stats["field_errors"]["description"] == {"placeholder": 1}
+
+
+def test_persona_zip_writer_sanitizes_names_and_dedupes(tmp_path):
+    path = str(tmp_path / "personas.zip")
+    personas = [
+        {"persona_id": "../../etc/passwd", "description": "甲"},
+        {"persona_id": "a/b", "description": "乙"},
+        {"persona_id": "a/b", "description": "乙"},
+    ]
+    with PersonaZipWriter(path) as writer:
+        assert writer.add(personas) == 2
+    with zipfile.ZipFile(path) as zipf:
+        names = zipf.namelist()
+    assert len(names) == 2
+    assert all("/" not in name and ".." not in name for name in names)
+
+
+def test_publish_persona_zip_replaces_whole_file(tmp_path):
+    path = str(tmp_path / "personas_partial.zip")
+    publish_persona_zip([{"persona_id": "1", "description": "甲"}], path)
+    publish_persona_zip([{"persona_id": "1", "description": "甲"}, {"persona_id": "2", "description": "乙"}], path)
+    with zipfile.ZipFile(path) as zipf:
+        assert sorted(zipf.namelist()) == ["PERSONA-1.json", "PERSONA-2.json"]
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_partial_zip_publisher_batches_republishing(tmp_path):
+    path = str(tmp_path / "personas_partial.zip")
+
+    async def run():
+        publisher = PartialZipPublisher(path, publish_seconds=0.05)
+        publisher.start()
+        for i in range(50):
+            publisher.put({"persona_id": str(i), "description": f"學習者 {i}"})
+            await asyncio.sleep(0)
+        await publisher.close()
+        return publisher.publishes
+
+    publishes = asyncio.run(run())
+    # 50 個 persona 在同一段等待時間內累積，不會每個都重新發布一次
+    assert publishes <= 2
+    with zipfile.ZipFile(path) as zipf:
+        assert len(zipf.namelist()) == 50
+
+
+def read_sink_output(path):
+    """依輪替順序讀回 PersonaSink 寫出的所有 persona"""
+    lines = []
+    for rotated in sorted(glob.glob(path + ".*.gz"), key=lambda name: int(name.rsplit(".", 2)[1])):
+        with gzip.open(rotated, "rt", encoding="utf-8") as f:
+            lines.extend(f)
+    with open(path, encoding="utf-8") as f:
+        lines.extend(f)
+    return [json.loads(line) for line in lines]
+
+
+def test_persona_sink_rotates_and_keeps_every_persona(tmp_path):
+    path = str(tmp_path / "persona.jsonl")
+    # 上次執行留下的輪替檔在 start 時清除
+    with gzip.open(path + ".9.gz", "wt") as f:
+        f.write("{}\n")
+
+    async def run():
+        sink = PersonaSink(path, max_bytes=200, batch_size=3, flush_seconds=0)
+        sink.start()
+        for i in range(20):
+            sink.put({"persona_id": str(i), "description": "每天通勤時用手機練習泰文會話"})
+            await asyncio.sleep(0)
+        await sink.close()
+        return sink
+
+    sink = asyncio.run(run())
+    assert sink.written == 20
+    assert sink.rotations > 1
+    assert not os.path.exists(path + ".9.gz")
+    assert len(glob.glob(path + ".*.gz")) == sink.rotations
+    assert [persona["persona_id"] for persona in read_sink_output(path)] == [str(i) for i in range(20)]
+
+
+def test_persona_sink_flushes_batches_before_close(tmp_path):
+    path = str(tmp_path / "persona.jsonl")
+
+    async def run():
+        sink = PersonaSink(path, flush_seconds=0.01)
+        sink.start()
+        for i in range(5):
+            sink.put({"persona_id": str(i)})
+        await asyncio.sleep(0.1)
+        # 尚未 close，累積的一批已經整批寫入並 flush 到檔案
+        with open(path, encoding="utf-8") as f:
+            flushed = f.read().splitlines()
+        await sink.close()
+        return flushed
+
+    flushed = asyncio.run(run())
+    assert [json.loads(line)["persona_id"] for line in flushed] == ["0", "1", "2", "3", "4"]
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from persona_common import pipeline
+
+
+class FakeClient:
+    hits = misses = saved_prompt_tokens = saved_completion_tokens = 0
+
+    def __init__(self, model):
+        self.model = model
+        self.closed = False
+
+    def endpoint_stats(self):
+        return []
+
+    async def close(self):
+        self.closed = True
+
+
+class RecordingSink:
+    def __init__(self):
+        self.personas = []
+        self.closed = False
+
+    def start(self):
+        pass
+
+    def put(self, persona):
+        self.personas.append(persona)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_run_pipeline_closes_clients_and_sink_on_error(tmp_path, monkeypatch):
+    csv_path = tmp_path / "survey.csv"
+    csv_path.write_text("q1,q2\n甲,乙\n", encoding="utf-8")
+    clients = []
+
+    def build_model_client(model):
+        clients.append(FakeClient(model))
+        return clients[-1]
+
+    async def run_scheduled(jobs, max_in_flight):
+        raise RuntimeError("排程失敗")
+
+    monkeypatch.setattr(pipeline, "CASCADE_ENABLED", True)
+    monkeypatch.setattr(pipeline, "build_model_client", build_model_client)
+    monkeypatch.setattr(pipeline, "create_team_pool", lambda *args, **kwargs: {})
+    monkeypatch.setattr(pipeline, "run_scheduled", run_scheduled)
+    sink = RecordingSink()
+    with pytest.raises(RuntimeError):
+        asyncio.run(pipeline.run_pipeline(str(csv_path), lambda *args: "", sink, output_dir=str(tmp_path)))
+    assert len(clients) == 2
+    assert all(client.closed for client in clients)
+    assert sink.closed
+
+
+def test_incremental_mode_reprocesses_only_changed_chunks(tmp_path, monkeypatch):
+    csv_path = tmp_path / "survey.csv"
+    rows = [f"學員{i},回答{i}" for i in range(6)]
+    processed = []
+
+    async def process_chunk(chunk, start_idx, total_records, team_pool, build_prompt, persona_sink, **kwargs):
+        processed.append(start_idx)
+        persona = {"persona_id": str(start_idx), "description": chunk.iloc[0, 1]}
+        persona_sink.put(persona)
+        return [], [persona]
+
+    async def reduce_personas(model_client, chunk_personas):
+        return [persona for personas in chunk_personas for persona in personas]
+
+    monkeypatch.setattr(pipeline, "CHUNK_ROWS", 2)
+    monkeypatch.setattr(pipeline, "build_model_client", FakeClient)
+    monkeypatch.setattr(pipeline, "create_team_pool", lambda *args, **kwargs: {})
+    monkeypatch.setattr(pipeline, "process_chunk", process_chunk)
+    monkeypatch.setattr(pipeline, "reduce_personas", reduce_personas)
+
+    def run():
+        csv_path.write_text("name,answer\n" + "\n".join(rows) + "\n", encoding="utf-8")
+        processed.clear()
+        sink = RecordingSink()
+        _, personas = asyncio.run(pipeline.run_pipeline(
+            str(csv_path), lambda *args: "", sink, incremental=True, output_dir=str(tmp_path),
+        ))
+        return personas, sink
+
+    run()
+    assert sorted(processed) == [0, 2, 4]
+
+    # 只改第二批的內容：其餘兩批沿用上次的 persona，只重新處理變動的批次
+    rows[3] = "學員3,改過的回答"
+    personas, sink = run()
+    assert processed == [2]
+    assert [persona["description"] for persona in personas] == ["回答0", "回答2", "回答4"]
+    assert len(sink.personas) == 3
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+from autogen_core.models import CreateResult, RequestUsage, UserMessage
+
+from persona_common.llm import CircuitBreaker, RoutedChatCompletionClient
+from persona_common.scheduler import run_scheduled
+
+
+def test_run_scheduled_limits_concurrency_and_keeps_order():
+    running = 0
+    peak = 0
+
+    async def job(i):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if i == 3:
+            raise ValueError("壞掉的批次")
+        return i
+
+    jobs = (lambda i=i: job(i) for i in range(8))
+    results = asyncio.run(run_scheduled(jobs, max_in_flight=2, breaker=CircuitBreaker()))
+    assert results == [0, 1, 2, None, 4, 5, 6, 7]
+    assert peak == 2
+
+
+def test_run_scheduled_reraises_reader_error_after_finishing_read_jobs():
+    finished = []
+
+    async def job(i):
+        finished.append(i)
+        return i
+
+    def jobs():
+        for i in range(3):
+            yield lambda i=i: job(i)
+        raise ValueError("CSV 解析失敗")
+
+    with pytest.raises(ValueError):
+        asyncio.run(run_scheduled(jobs(), max_in_flight=2, breaker=CircuitBreaker()))
+    assert sorted(finished) == [0, 1, 2]
+
+
+class FakeEndpointClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, messages, **kwargs):
+        self.calls += 1
+        return CreateResult(finish_reason="stop", content="ok", usage=RequestUsage(prompt_tokens=1, completion_tokens=1), cached=False)
+
+
+def test_routed_client_charges_quota_per_call():
+    first, second = FakeEndpointClient(), FakeEndpointClient()
+    client = RoutedChatCompletionClient([("a", "m", first), ("b", "m", second)], rpm=2)
+    messages = [UserMessage(content="你好", source="user")]
+
+    async def main():
+        for _ in range(4):
+            await client.create(messages)
+        # 兩個端點各兩次後配額用盡，第五次呼叫要等視窗滑出才會放行
+        return await asyncio.wait_for(client.create(messages), timeout=0.2)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(main())
+    assert (first.calls, second.calls) == (2, 2)
+
+
+def test_routed_client_token_quota_skips_full_endpoint():
+    first, second = FakeEndpointClient(), FakeEndpointClient()
+    client = RoutedChatCompletionClient([("a", "m", first), ("b", "m", second)], rpm=100, tpm=150)
+    messages = [UserMessage(content="字" * 100, source="user")]
+
+    async def main():
+        await client.create(messages)
+        await client.create(messages)
+
+    asyncio.run(main())
+    assert (first.calls, second.calls) == (1, 1)
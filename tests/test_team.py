@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import pandas as pd
+from autogen_agentchat.messages import StopMessage, TextMessage
+from autogen_ext.models.replay import ReplayChatCompletionClient
+
+from persona_common import team
+from persona_common.pipeline import process_chunk
+
+PERSONA = {
+    "persona_id": "1", "description": "上班族想在旅遊時和當地人聊天", "motivation": "去泰國自助旅行",
+    "challenges": "每天只有零碎時間", "learning_goals": "能進行日常會話", "preferred_learning_methods": "手機 App",
+    "suggested_learning_resources": [{"feature_name": "App", "description": "每日練習", "justification": "零碎時間"}],
+}
+
+
+class RecordingReplayClient(ReplayChatCompletionClient):
+    """記錄每次串流請求帶了幾則訊息，用來確認借出的 team 已重置、沒有殘留上一個批次的對話"""
+
+    model = "replay"
+
+    def __init__(self, responses):
+        super().__init__(responses)
+        self.request_sizes = []
+
+    def create_stream(self, messages, **kwargs):
+        self.request_sizes.append(len(messages))
+        return super().create_stream(messages, **kwargs)
+
+
+class ListSink:
+    def __init__(self):
+        self.personas = []
+
+    def put(self, persona):
+        self.personas.append(persona)
+
+
+def test_full_team_is_pinned_to_the_large_model_in_cascade_mode(monkeypatch):
+    monkeypatch.setattr(team, "CASCADE_ENABLED", True)
+    assert team.full_team_model() == team.CASCADE_FULL_MODEL == "gemini-2.0-flash"
+    assert team.full_team_model() != team.CASCADE_DRAFT_MODEL
+    monkeypatch.setattr(team, "CASCADE_ENABLED", False)
+    assert team.full_team_model() is None
+
+
+def test_termination_stops_on_terminate_message_limit_or_external_signal(monkeypatch):
+    monkeypatch.setattr(team, "TEAM_MAX_MESSAGES", 3)
+
+    async def run():
+        reply = [TextMessage(content="還在分析", source="data_agent")]
+        termination, stop_signal = team.build_termination()
+        stopped = [await termination(reply) for _ in range(3)]
+        await termination.reset()
+        said_terminate = await termination([TextMessage(content="TERMINATE", source="report_generator")])
+        await termination.reset()
+        before_signal = await termination(reply)
+        stop_signal.set()
+        after_signal = await termination(reply)
+        return stopped, said_terminate, before_signal, after_signal
+
+    stopped, said_terminate, before_signal, after_signal = asyncio.run(run())
+    assert stopped[:2] == [None, None]
+    assert isinstance(stopped[2], StopMessage)
+    assert isinstance(said_terminate, StopMessage)
+    assert before_signal is None
+    assert isinstance(after_signal, StopMessage)
+
+
+def test_team_pool_reuses_a_reset_team_and_stops_once_a_persona_is_found():
+    client = RecordingReplayClient([json.dumps(PERSONA, ensure_ascii=False)] * 10)
+    chunk = pd.DataFrame({"q": ["a", "b"]})
+
+    async def run():
+        pool = team.create_team_pool(client, size=1)
+        borrowed, _ = pool["queue"]._queue[0]
+        runs = []
+        for start_idx in (0, 2):
+            sink = ListSink()
+            messages, personas = await process_chunk(chunk, start_idx, 4, pool, lambda *args: "prompt", sink, echo_messages=False)
+            runs.append((messages, personas, sink.personas))
+            # 批次結束後同一組 team 歸還到 pool
+            assert pool["queue"].qsize() == 1
+            assert pool["queue"]._queue[0][0] is borrowed
+        return runs
+
+    runs = asyncio.run(run())
+    for messages, personas, sunk in runs:
+        # 取得有效的 persona 後由外部訊號提早結束，不會用完訊息數上限
+        assert len(messages) < team.TEAM_MAX_MESSAGES
+        assert all(row["stop_reason"] and "External" in row["stop_reason"] for row in messages)
+        assert personas and sunk == personas
+    # 兩個批次的請求大小一致：重置後的 team 不帶上一批次的對話
+    half = len(client.request_sizes) // 2
+    assert client.request_sizes[:half] == client.request_sizes[half:]
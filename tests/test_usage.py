@@ -0,0 +1,82 @@
+import asyncio
+
+from autogen_core.models import CreateResult, RequestUsage, UserMessage
+
+from persona_common.llm import CachedChatCompletionClient
+from persona_common.usage import UsageTracker
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, messages, **kwargs):
+        self.calls += 1
+        return CreateResult(finish_reason="stop", content="ok", usage=RequestUsage(prompt_tokens=100, completion_tokens=20), cached=False)
+
+
+def test_cache_hit_reports_zero_usage_and_tracker_skips_it(tmp_path):
+    inner = FakeClient()
+    client = CachedChatCompletionClient(inner, "gemini-2.0-flash", path=str(tmp_path / "llm.sqlite"), mode="readwrite")
+    messages = [UserMessage(content="你好", source="user")]
+    first = asyncio.run(client.create(messages))
+    second = asyncio.run(client.create(messages))
+    assert inner.calls == 1
+    assert second.cached and second.usage.prompt_tokens == 0
+    assert (client.saved_prompt_tokens, client.saved_completion_tokens) == (100, 20)
+
+    tracker = UsageTracker()
+    for result in (first, second):
+        tracker.record_message(0, "draft_agent", "gemini-2.0-flash", result.usage, cached=result.cached)
+    row = tracker.summary().iloc[0]
+    assert (row["messages"], row["cached_messages"], row["prompt_tokens"], row["completion_tokens"]) == (2, 1, 100, 20)
+
+
+def test_router_reports_the_model_that_served_each_result(tmp_path):
+    from persona_common.llm import RoutedChatCompletionClient, served_endpoint, served_model
+
+    inner = RoutedChatCompletionClient([("gemini-1.5-flash-8b#1", "gemini-1.5-flash-8b", FakeClient())])
+    client = CachedChatCompletionClient(inner, "gemini-2.0-flash+gemini-1.5-flash-8b", path=str(tmp_path / "llm.sqlite"))
+    messages = [UserMessage(content="你好", source="user")]
+    first = asyncio.run(client.create(messages))
+    # 命中快取時仍回報當初實際回應的模型與端點
+    second = asyncio.run(client.create(messages))
+    for result in (first, second):
+        assert served_model(result.usage, client.model) == "gemini-1.5-flash-8b"
+        assert served_endpoint(result.usage) == "gemini-1.5-flash-8b#1"
+
+    tracker = UsageTracker()
+    tracker.record_message(0, "data_agent", served_model(first.usage, client.model), first.usage)
+    row = tracker.summary().iloc[0]
+    assert row["model"] == "gemini-1.5-flash-8b"
+    assert row["cost_usd"] == (100 * 0.0375 + 20 * 0.15) / 1_000_000
+
+
+def test_default_model_pool_spreads_one_model_across_keys(monkeypatch):
+    from persona_common import llm
+
+    monkeypatch.setattr(llm, "GEMINI_API_KEYS", ["key-1", "key-2"])
+    assert llm.GEMINI_MODELS == [llm.DEFAULT_GEMINI_MODEL]
+    client = llm.build_model_client()
+    assert client.model == llm.DEFAULT_GEMINI_MODEL
+    assert [stat["model"] for stat in client.endpoint_stats()] == [llm.DEFAULT_GEMINI_MODEL] * 2
+    asyncio.run(client.close())
+
+
+def test_cache_evicts_least_recently_used_below_the_cap(tmp_path):
+    from persona_common import llm
+
+    client = CachedChatCompletionClient(FakeClient(), "gemini-2.0-flash", path=str(tmp_path / "llm.sqlite"), max_bytes=10 ** 6)
+    for i in range(10):
+        asyncio.run(client.create([UserMessage(content=f"問題 {i}", source="user")]))
+    size = client._total_bytes // 10
+    assert client._total_bytes == client._db.execute("SELECT SUM(size) FROM responses").fetchone()[0]
+
+    # 上限只夠放約 5 筆：超過時一次淘汰到上限的 90% 以下，最早寫入的回應先被刪除
+    client._max_bytes = size * 5
+    asyncio.run(client.create([UserMessage(content="問題 10", source="user")]))
+    remaining = client._db.execute("SELECT COUNT(*), SUM(size) FROM responses").fetchone()
+    assert remaining[1] == client._total_bytes <= client._max_bytes * llm.LLM_CACHE_EVICT_TO
+    assert remaining[0] == 4
+    assert asyncio.run(client.create([UserMessage(content="問題 10", source="user")])).cached
+    assert not asyncio.run(client.create([UserMessage(content="問題 0", source="user")])).cached
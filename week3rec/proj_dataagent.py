@@ -1,4 +1,5 @@
 import os
+import sys
 import asyncio
 import pandas as pd
 from dotenv import load_dotenv
@@ -16,7 +17,12 @@ from autogen_agentchat.conditions import TextMentionTermination
 from autogen_agentchat.teams import RoundRobinGroupChat
 from autogen_agentchat.messages import TextMessage
 from autogen_ext.models.openai import OpenAIChatCompletionClient
-from autogen_ext.agents.web_surfer import MultimodalWebSurfer
+
+# 共用模組放在專案根目錄的 persona_common；快取目錄以程式所在位置為準，不受執行時的工作目錄影響
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+os.environ.setdefault("PERSONA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".persona_cache"))
+
+from persona_common.interviews import research_learning_resources
 
 async def read_md_files(file_paths):
     """
@@ -31,7 +37,7 @@ async def read_md_files(file_paths):
     print(f"總共讀取到 {len(md_content)} 個 MD 檔案")
     return md_content
 
-async def process_chunk(chunk, start_idx, total_records, model_client, termination_condition, md_content):
+async def process_chunk(chunk, start_idx, total_records, model_client, termination_condition, md_content, research):
     """
     處理單一批次資料，並結合讀取的 .md 文件內容提供給代理人。
     只存入最終 Persona，而非完整對話紀錄。
@@ -44,8 +50,8 @@ async def process_chunk(chunk, start_idx, total_records, model_client, terminati
         f"以下為該批次問卷資料:\n{chunk_data}\n\n"
         "這是訪談的資料：\n" + "\n".join(md_content) + "\n"
         "請根據以上問卷資料與訪談進行分析，**生成課程受眾的 persona 概觀**，"
-        "此外，請 MultimodalWebSurfer 搜尋外部網站，尋找最新的泰文學習建議的學習資源，\n"
-        "並將搜尋結果整合到 persona 概觀。\n"
+        "此外，以下為外部網站搜尋到的最新泰文學習建議的學習資源：\n" + research + "\n"
+        "請將這些學習資源整合到 persona 概觀。\n"
         "請將輸出格式為 JSON，範例如下：\n"
         "```json\n"
         "{\n"
@@ -62,12 +68,11 @@ async def process_chunk(chunk, start_idx, total_records, model_client, terminati
     )
 
     assistant_1 = AssistantAgent("data_agent", model_client)
-    web_surfer = MultimodalWebSurfer("web_surfer", model_client)
     assistant_2 = AssistantAgent("assistant", model_client)
     report_generator = AssistantAgent("report_generator", model_client)
 
     local_team = RoundRobinGroupChat(
-        [assistant_1, web_surfer, assistant_2, report_generator],
+        [assistant_1, assistant_2, report_generator],
         termination_condition=termination_condition,
     )
 
@@ -114,6 +119,9 @@ async def main():
     print("開始讀取 MD 檔案...")
     md_content = await read_md_files(md_file_paths)
 
+    # 外部學習資源只搜尋一次，所有批次共用
+    research = await research_learning_resources(model_client)
+
     csv_file_path = "/Users/Peggy/Documents/113-2 net_learning/week3/課程問券_泰文課.csv"
     chunk_size = 1000
     with open(csv_file_path, 'rb') as f:
@@ -134,7 +142,7 @@ async def main():
 
     print("開始處理各個批次資料...")
     tasks = [
-        process_chunk(chunk, idx * chunk_size, total_records, model_client, termination_condition, md_content)
+        process_chunk(chunk, idx * chunk_size, total_records, model_client, termination_condition, md_content, research)
         for idx, chunk in enumerate(chunks)
     ]
     results = await asyncio.gather(*tasks)
@@ -1,11 +1,18 @@
 import os
 import json
 import time
+import random
+import hashlib
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from types import SimpleNamespace
 import pandas as pd
 import requests
+import httpx
 from dotenv import load_dotenv
 from google import genai
-from google.genai.errors import ServerError
+from google.genai.errors import APIError, ClientError, ServerError
 
 # 載入 .env 中的環境變數
 load_dotenv()
@@ -77,6 +84,163 @@ def parse_response(response_text):
         print(f"解析 JSON 失敗：{e}")
         return {item: "" for item in CATEGORIES}
 
+# Gemini 回應快取設定：存放位置、容量上限，以及模式
+# "readwrite"：命中直接回傳，未命中時呼叫模型並寫入快取
+# "replay"：唯讀重播，命中直接回傳，未命中時呼叫模型但不寫入快取
+LLM_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".persona_cache", "llm_cache.sqlite3")
+LLM_CACHE_MAX_BYTES = 512 * 1024 * 1024
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "readwrite")
+
+# 重試與斷路器設定：最多重試次數、指數退避的基準與上限秒數、連續失敗幾次後斷開與冷卻秒數
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN_SECONDS = 30.0
+# hedging：請求超過此秒數仍未回應時再送出一個相同的請求，取先回應者；會增加費用，預設關閉（0）
+HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", "0"))
+# 可改指向其他端點，例如本機回傳 429 的測試伺服器
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+
+class CircuitOpenError(Exception):
+    """斷路器斷開期間不送出請求"""
+
+class CircuitBreaker:
+    """連續失敗達 failure_threshold 次就斷開 cooldown 秒，期間的請求直接失敗，不再打擾模型服務"""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None and time.monotonic() - self._opened_at < self.cooldown
+
+    def record_success(self):
+        self.failures = 0
+        self._opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+
+provider_breaker = CircuitBreaker()
+
+def is_retryable(error):
+    """5xx、429（配額用盡）與連線錯誤（含逾時）值得重試，其餘 4xx 直接丟出"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, ServerError) or (isinstance(error, ClientError) and error.code == 429)
+
+def retry_after_seconds(error):
+    """依序讀取 Retry-After 標頭與錯誤內容中的 RetryInfo.retryDelay（例如 "30s"），沒有時回傳 None"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after"):
+            return max(float(headers["retry-after"]), 0.0)
+    except ValueError:
+        pass
+    details = getattr(error, "details", None)
+    details = details if isinstance(details, dict) else {}
+    for detail in details.get("error", {}).get("details", []):
+        delay = str(detail.get("retryDelay", ""))
+        if delay.endswith("s"):
+            try:
+                return max(float(delay[:-1]), 0.0)
+            except ValueError:
+                pass
+    return None
+
+def generate_hedged(client, model, contents, hedge_after=HEDGE_AFTER_SECONDS):
+    """
+    呼叫 generate_content；hedge_after 大於 0 且超過該秒數仍未回應時，再送出一個相同的請求，取先成功者。
+    兩個請求都失敗時丟出第一個請求的錯誤。
+    """
+    if not hedge_after:
+        return client.models.generate_content(model=model, contents=contents)
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        first = executor.submit(client.models.generate_content, model=model, contents=contents)
+        done, _ = wait([first], timeout=hedge_after)
+        if done:
+            return first.result()
+        pending = {first, executor.submit(client.models.generate_content, model=model, contents=contents)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        return first.result()
+    finally:
+        # 不等待較慢的請求結束，它在背景完成後結果直接捨棄
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def generate_with_retry(client, model, contents, breaker=provider_breaker, max_attempts=RETRY_MAX_ATTEMPTS):
+    """
+    呼叫 generate_content，遇到可重試的錯誤時以指數退避加隨機抖動重試，並優先遵守伺服器指定的等待時間。
+    連線錯誤與逾時也會重試。連續失敗會讓斷路器斷開，斷開期間直接丟出 CircuitOpenError。
+    """
+    for attempt in range(max_attempts):
+        if breaker.is_open:
+            raise CircuitOpenError("模型服務暫時無法使用，稍後再試")
+        try:
+            response = generate_hedged(client, model, contents)
+        except (ServerError, ClientError, httpx.TransportError) as e:
+            if not is_retryable(e):
+                raise
+            breaker.record_failure()
+            if attempt == max_attempts - 1 or breaker.is_open:
+                raise
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+            delay = min(delay, RETRY_MAX_SECONDS)
+            print(f"Gemini 呼叫失敗（{getattr(e, 'code', None) or type(e).__name__}），{delay:.1f} 秒後重試（第 {attempt + 1} 次）")
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return response
+
+def generate_content_cached(client, model, contents, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES, mode=LLM_CACHE_MODE):
+    """
+    包在 client.models.generate_content 外層的回應快取，以 (model, contents) 的雜湊值為鍵，
+    回應文字存在 SQLite，超過容量上限時從最久沒用到的回應開始淘汰（LRU）。
+    """
+    raw = json.dumps({"model": model, "contents": contents}, sort_keys=True, ensure_ascii=False, default=str)
+    key = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with closing(sqlite3.connect(path)) as db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        row = db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            print("使用快取的 Gemini 回應")
+            if mode != "replay":
+                db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                db.commit()
+            return SimpleNamespace(text=row[0])
+
+        response = generate_with_retry(client, model, contents)
+        if mode != "replay" and response.text:
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response.text, len(response.text.encode("utf-8")), time.time()),
+            )
+            # 超過容量上限時，從最久沒用到的回應開始刪除
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            for old_key, size in db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+                if total <= max_bytes:
+                    break
+                db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                total -= size
+            db.commit()
+        return response
+
 # 使用 Gemini API 分類批次處理的討論
 def process_batch_dialogue(client, dialogues: list, delimiter="-----"):
     prompt = (
@@ -95,11 +259,8 @@ def process_batch_dialogue(client, dialogues: list, delimiter="-----"):
     content = prompt + "\n\n" + batch_text
 
     try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=content
-        )
-    except ServerError as e:
+        response = generate_content_cached(client, "gemini-2.0-flash", content)
+    except (APIError, CircuitOpenError, httpx.TransportError) as e:
         print(f"API 呼叫失敗：{e}")
         return [{item: "" for item in CATEGORIES} for _ in dialogues]
     
@@ -133,7 +294,7 @@ def main():
     # 載入 GEMINI API 客戶端
     if not gemini_api_key:
         raise ValueError("請設定環境變數 GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
+    client = genai.Client(api_key=gemini_api_key, http_options={"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else None)
 
     # 處理批次並儲存結果
     batch_results = process_batch_dialogue(client, dialogues)
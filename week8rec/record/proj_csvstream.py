@@ -1,38 +1,25 @@
 import os
-import asyncio
-import pandas as pd
-import json
+import sys
 from dotenv import load_dotenv
-import chardet
-import tempfile
-import shutil
 import gradio as gr
-import re
-import zipfile
 
 # 載入 .env 檔案中的環境變數
 load_dotenv()
 
-from autogen_agentchat.agents import AssistantAgent
-from autogen_agentchat.conditions import TextMentionTermination
-from autogen_agentchat.teams import RoundRobinGroupChat
-from autogen_agentchat.messages import TextMessage
-from autogen_ext.models.openai import OpenAIChatCompletionClient
+# 共用模組放在專案根目錄的 persona_common；快取目錄以程式所在位置為準，不受執行時的工作目錄影響
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+os.environ.setdefault("PERSONA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".persona_cache"))
 
-# 檢查是否為有效資料（忽略空白或占位符的欄位）
-def is_valid_persona(persona):
-    """檢查 persona 是否有效"""
-    if persona["description"] == "..." or persona["motivation"] == "..." or persona["challenges"] == "..." or persona["learning_goals"] == "..." or persona["preferred_learning_methods"] == "...":
-        return False
-    if any(res["feature_name"] == "..." or res["description"] == "..." or res["justification"] == "..." for res in persona["suggested_learning_resources"]):
-        return False
-    return True
+from persona_common.pipeline import run_pipeline
+from persona_common.personas import PersonaZipWriter, PartialZipPublisher
+from persona_common.logs import LOG_FORMAT
+from persona_common.jobs import JOB_PREVIEW_COLUMNS, JOB_PARTIAL_ZIP, get_job_manager, format_job_status, upload_path, watch_job
 
-# 處理單一批次資料
-async def process_chunk(chunk, start_idx, total_records, model_client, termination_condition):
-    chunk_data = chunk.to_dict(orient='records')
-    prompt = (
-        f"目前正在處理第 {start_idx} 至 {start_idx + len(chunk) - 1} 筆問卷資料（共 {total_records} 筆）。\n"
+def build_prompt(chunk_data, start_idx, end_idx, total_records):
+    """產生單一批次的 prompt"""
+    return (
+        f"目前正在處理第 {start_idx} 至 {end_idx} 筆問卷資料（共 {total_records} 筆）。\n"
+        f"以下為該批次問卷資料:\n{chunk_data}\n\n"
         "請根據以上問卷資料行分析，生成完整的課程受眾的 persona 概觀，"
         "須包含下列欄位：\n"
         "- persona_id (以數字為主，從1開始列到n)\n"
@@ -63,118 +50,55 @@ async def process_chunk(chunk, start_idx, total_records, model_client, terminati
         "請確保只輸出上述 JSON，不要包含其他對話內容。\n"
     )
 
-    assistant_1 = AssistantAgent("data_agent", model_client)
-    assistant_2 = AssistantAgent("assistant", model_client)
-    report_generator = AssistantAgent("report_generator", model_client)
-
-    local_team = RoundRobinGroupChat(
-        [assistant_1, assistant_2, report_generator],
-        termination_condition=termination_condition,
+async def process_all(csv_path, resume=False, incremental=False, output_dir=".", on_event=None):
+    """
+    讀取問卷 CSV 並產生 persona（見 run_pipeline）。
+    處理途中定期更新 personas_partial.zip 即可下載目前的結果，合併後的 persona 寫入 personas.zip。
+    """
+    partial_zip = PartialZipPublisher(os.path.join(output_dir, JOB_PARTIAL_ZIP))
+    result = await run_pipeline(
+        csv_path, build_prompt, partial_zip,
+        resume=resume, incremental=incremental, output_dir=output_dir, on_event=on_event, echo_messages=False,
     )
-
-    messages = []
-    personas = []
-
-    async for event in local_team.run_stream(task=prompt):
-        if isinstance(event, TextMessage):
-            messages.append({
-                "batch_start": start_idx,
-                "batch_end": start_idx + len(chunk) - 1,
-                "source": event.source,
-                "content": event.content,
-                "type": event.type,
-            })
-            matches = re.findall(r"```json\n(.*?)\n```", event.content, re.DOTALL)
-            for match in matches:
-                try:
-                    parsed = json.loads(match)
-                    if isinstance(parsed, list):
-                        for persona in parsed:
-                            if is_valid_persona(persona):
-                                personas.append(persona)
-                    elif isinstance(parsed, dict):
-                        if is_valid_persona(parsed):
-                            personas.append(parsed)
-                except json.JSONDecodeError as e:
-                    print(f"JSON解析失敗: {e}")
-    return messages, personas
-
-async def process_all(csv_path):
-    with open(csv_path, 'rb') as f:
-        raw_data = f.read(10000)
-    result = chardet.detect(raw_data)
-    encoding = result['encoding']
-    print(f"檢測到的 CSV 編碼格式: {encoding}")
-
-    try:
-        chunks = list(pd.read_csv(csv_path, chunksize=1000, encoding=encoding))
-    except Exception as e:
-        print(f"無法讀取 CSV 檔案: {e}")
+    if result is None:
         return None, None
+    output_csv, all_personas = result
 
-    total_records = sum(chunk.shape[0] for chunk in chunks)
-    gemini_api_key = os.environ.get("Gemini_api")
-    model_client = OpenAIChatCompletionClient(model="gemini-2.0-flash", api_key=gemini_api_key)
-    termination_condition = TextMentionTermination("TERMINATE")
-
-    tasks = []
-
-    # 處理批次資料
-    for idx, chunk in enumerate(chunks):
-        tasks.append(process_chunk(chunk, idx * 1000, total_records, model_client, termination_condition))
-
-    results = await asyncio.gather(*tasks)
-    all_messages = []
-    all_personas = []
-    for batch_messages, batch_personas in results:
-        all_messages.extend(batch_messages)
-        all_personas.extend(batch_personas)
-
-    output_csv = "all_conve_log.csv"
-    df_log = pd.DataFrame(all_messages)
-    df_log.to_csv(output_csv, index=False, encoding="utf-8-sig")
-
-    # 創建 ZIP 檔案
-    zip_filename = "personas.zip"
-    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for persona in all_personas:
-            if persona.get("persona_id"):
-                persona_id = persona["persona_id"]
-                file_name = f"PERSONA-{persona_id}.json"
-                with open(file_name, 'w', encoding='utf-8') as json_file:
-                    json.dump(persona, json_file, ensure_ascii=False, indent=4)
-                zipf.write(file_name)
-                os.remove(file_name)  # 刪除暫時檔案
+    # 直接從記憶體寫入 ZIP，內容相同的 persona 只保留一份
+    zip_filename = os.path.join(output_dir, "personas.zip")
+    with PersonaZipWriter(zip_filename) as writer:
+        written = writer.add(all_personas)
+    print(f"已將 {written} 個 persona 寫入 {zip_filename}")
 
     return output_csv, zip_filename
 
-def process_files(csv_file):
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        csv_path = os.path.join(tmpdirname, "input.csv")
-        shutil.copy(csv_file, csv_path)
 
-        current_dir = os.getcwd()
-        os.chdir(tmpdirname)
-        try:
-            output_csv, output_zip = asyncio.run(process_all(csv_path))
-            dest_csv = os.path.join(current_dir, output_csv)
-            dest_zip = os.path.join(current_dir, output_zip)
-            shutil.copy(output_csv, dest_csv)
-            shutil.copy(output_zip, dest_zip)
-        finally:
-            os.chdir(current_dir)
-        return dest_csv, dest_zip
+def submit_job(csv_file, resume=False, incremental=False):
+    """建立背景 job 後立即返回 job id，進度與結果由 watch_job 串流取得"""
+    job_manager = get_job_manager()
+    job = job_manager.create()
+    csv_path = upload_path(csv_file, job["dir"], "input.csv")
+    job_manager.start(job, process_all, csv_path, resume, incremental)
+    return job["id"], format_job_status(job)
 
 
 with gr.Blocks() as demo:
     gr.Markdown("# Persona 分析系統")
     with gr.Row():
         csv_input = gr.File(label="上傳 CSV 檔案", file_count="single")
+    resume_input = gr.Checkbox(label="從上次中斷處繼續", value=False)
+    incremental_input = gr.Checkbox(label="只處理新增的問卷資料（增量模式）", value=False)
     start_btn = gr.Button("開始")
+    job_id_input = gr.Textbox(label="job id（可輸入先前的 job id 查詢進度與結果）")
+    status_output = gr.Markdown()
+    persona_output = gr.Dataframe(label="已產生的 persona（即時更新）", headers=JOB_PREVIEW_COLUMNS, interactive=False)
     with gr.Row():
-        csv_output = gr.File(label="下載對話紀錄 CSV")
+        csv_output = gr.File(label=f"下載對話紀錄 {LOG_FORMAT.upper()}")
         zip_output = gr.File(label="下載 Persona JSON (ZIP)")
-    start_btn.click(fn=process_files, inputs=[csv_input], outputs=[csv_output, zip_output])
+    start_btn.click(fn=submit_job, inputs=[csv_input, resume_input, incremental_input], outputs=[job_id_input, status_output]).then(
+        fn=watch_job, inputs=[job_id_input], outputs=[status_output, persona_output, csv_output, zip_output]
+    )
+    job_id_input.submit(fn=watch_job, inputs=[job_id_input], outputs=[status_output, persona_output, csv_output, zip_output])
 
 if __name__ == '__main__':
     demo.launch(share=True)
\ No newline at end of file
@@ -1,43 +1,45 @@
 import os
+import sys
 import asyncio
-import pandas as pd
 from dotenv import load_dotenv
-import chardet
 import json
-import re
-import tempfile
-import shutil
-import zipfile
 import gradio as gr
 
 # 載入 .env 檔案中的環境變數
 load_dotenv()
 
 from autogen_agentchat.agents import AssistantAgent
-from autogen_agentchat.conditions import TextMentionTermination
 from autogen_agentchat.teams import RoundRobinGroupChat
-from autogen_agentchat.messages import TextMessage
+from autogen_agentchat.base import TaskResult
+from autogen_agentchat.messages import TextMessage, ModelClientStreamingChunkEvent
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 
-async def read_md_files_from_paths(file_paths):
-    """讀取多個 .md 檔案，返回內容列表"""
-    md_content = []
-    for file_path in file_paths:
-        print(f"正在讀取 {file_path} ...")
-        with open(file_path, "r", encoding="utf-8") as file:
-            content = file.read()
-            md_content.append(content)
-    print(f"總共讀取到 {len(md_content)} 個 MD 檔案")
-    return md_content
-
-async def process_chunk(chunk, start_idx, total_records, model_client, termination_condition, md_content):
-    """處理單一批次資料"""
+# 共用模組放在專案根目錄的 persona_common；快取目錄以程式所在位置為準，不受執行時的工作目錄影響
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+os.environ.setdefault("PERSONA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".persona_cache"))
+
+from persona_common.interviews import read_md_files_from_paths, build_interview_digest
+from persona_common.personas import validate_personas, print_validation_stats, JsonStreamExtractor, PersonaSink, PersonaZipWriter
+from persona_common.team import build_termination
+from persona_common.logs import LOG_FORMAT, ConversationLogWriter, conversation_log_path
+from persona_common.jobs import JOB_PREVIEW_COLUMNS, get_job_manager, format_job_status, upload_path, watch_job
+
+# 訪談摘要放在 system message 的最前面，各批次共用相同前綴，可利用供應商端的 prompt 快取
+INTERVIEW_SYSTEM_MESSAGE = (
+    "以下是本次分析共用的訪談摘要，所有批次都以此作為背景資料：\n"
+    "{digest}\n\n"
+    "You are a helpful AI assistant. Solve tasks using your tools. "
+    "Reply with TERMINATE when the task has been completed."
+)
+
+async def process_chunk(chunk, start_idx, total_records, model_client, interview_digest, persona_sink, on_event=None):
+    """處理單一批次資料（單一訪談檔），所有訪談的摘要透過共用的 system message 提供"""
     chunk_data = chunk
     print(f"處理批次起始索引 {start_idx}, 批次筆數: {len(chunk)}")
 
     prompt = (
-        "這是訪談的資料：\n" + "\n".join(md_content) + "\n\n"
-        "請根據以上問卷資料與訪談進行分析，生成完整的課程受眾的 persona 概觀，"
+        "這是本批次的訪談資料：\n" + chunk_data + "\n\n"
+        "請根據以上訪談，並參考系統訊息中所有訪談的摘要進行分析，生成完整的課程受眾的 persona 概觀，"
         "須包含下列欄位：\n"
         "- persona_id (以數字為主，從1開始列到n)\n"
         "- description (對該 persona 的整體描述)\n"
@@ -67,10 +69,13 @@ async def process_chunk(chunk, start_idx, total_records, model_client, terminati
         "請確保只輸出上述 JSON，不要包含其他對話內容。\n"
     )
 
-    assistant_1 = AssistantAgent("data_agent", model_client)
-    assistant_2 = AssistantAgent("assistant", model_client)
-    report_generator = AssistantAgent("report_generator", model_client)
+    system_message = INTERVIEW_SYSTEM_MESSAGE.format(digest=interview_digest)
+    assistant_1 = AssistantAgent("data_agent", model_client, system_message=system_message, model_client_stream=True)
+    assistant_2 = AssistantAgent("assistant", model_client, model_client_stream=True)
+    report_generator = AssistantAgent("report_generator", model_client, system_message=system_message, model_client_stream=True)
 
+    # 每個批次使用自己的終止條件，同時執行的批次不會互相影響
+    termination_condition, stop_signal = build_termination()
     local_team = RoundRobinGroupChat(
         [assistant_1, assistant_2, report_generator],
         termination_condition=termination_condition,
@@ -78,10 +83,22 @@ async def process_chunk(chunk, start_idx, total_records, model_client, terminati
 
     messages = []
     personas = []
+    stop_reason = None
 
+    def emit(event):
+        # 即時回報 persona 與 token 用量給呼叫端（例如背景 job 的進度顯示）
+        if on_event is not None:
+            on_event(dict(event, batch_start=start_idx))
+
+    extractors = {}
     async for event in local_team.run_stream(task=prompt):
-        if isinstance(event, TextMessage):
+        if isinstance(event, ModelClientStreamingChunkEvent):
+            # 串流輸出時邊收邊解析，persona 一輸出完成就寫入
+            found = extractors.setdefault(event.source, JsonStreamExtractor()).feed(event.content)
+        elif isinstance(event, TextMessage):
             print(f"[{event.source}] => {event.content}\n")
+            if event.source != "user" and event.models_usage is not None:
+                emit({"type": "usage", "prompt_tokens": event.models_usage.prompt_tokens, "completion_tokens": event.models_usage.completion_tokens})
             messages.append({
                 "batch_start": start_idx,
                 "batch_end": start_idx + len(chunk) - 1,
@@ -91,142 +108,119 @@ async def process_chunk(chunk, start_idx, total_records, model_client, terminati
                 "prompt_tokens": event.models_usage.prompt_tokens if event.models_usage else None,
                 "completion_tokens": event.models_usage.completion_tokens if event.models_usage else None
             })
-            # 使用正則表達式匹配所有以 ```json 開頭的區塊
-            matches = re.findall(r"```json\n(.*?)\n```", event.content, re.DOTALL)
-            for match in matches:
-                try:
-                    parsed = json.loads(match)
-                    if isinstance(parsed, list):
-                        for persona in parsed:
-                            personas.append(persona)
-                            with open("persona_output.json", "a", encoding="utf-8") as f:
-                                json.dump(persona, f, ensure_ascii=False, indent=4)
-                    elif isinstance(parsed, dict):
-                        personas.append(parsed)
-                        with open("persona_output.json", "a", encoding="utf-8") as f:
-                            json.dump(parsed, f, ensure_ascii=False, indent=4)
-                except json.JSONDecodeError as e:
-                    print(f"JSON解析失敗: {e}")
+            # 已串流過的訊息在收到 chunk 時就解析完畢，未經串流的回覆在此一次解析
+            # task 本身（source 為 user）含有 JSON 格式範例，不解析
+            found = [] if event.source == "user" or extractors.pop(event.source, None) else JsonStreamExtractor().feed(event.content)
+        elif isinstance(event, TaskResult):
+            stop_reason = event.stop_reason
+            continue
+        else:
+            continue
+        # 先驗證再寫入 sink，不合格的 persona 不會出現在輸出檔與介面上
+        valid, stats = validate_personas(found)
+        if stats["rejected"]:
+            print_validation_stats(stats)
+        personas.extend(valid)
+        for persona in valid:
+            persona_sink.put(persona)
+            emit({"type": "persona", "persona": persona})
+        # 取得有效的 persona 後就結束，不必等其他 agent 輪流發言
+        if valid:
+            stop_signal.set()
+    # 每列對話紀錄都記下本批次停止的原因
+    for row in messages:
+        row["stop_reason"] = stop_reason
     return messages, personas
 
-async def process_all(md_paths):
+# 對話紀錄的欄位與型別（訪談批次沒有模型資訊，不含 persona_model 欄位）
+LOG_COLUMNS = {
+    "batch_start": "int",
+    "batch_end": "int",
+    "source": "str",
+    "content": "str",
+    "type": "str",
+    "prompt_tokens": "int",
+    "completion_tokens": "int",
+    "stop_reason": "str",
+}
+
+async def process_all(md_paths, output_dir=".", on_event=None):
+    """
+    分析上傳的訪談 MD 檔案，每個檔案為一個批次。
+    輸出檔案寫入 output_dir；on_event 在執行中回報批次進度、persona 與 token 用量（見 stream_pipeline）。
+    """
     md_content = await read_md_files_from_paths(md_paths)
 
     gemini_api_key = os.environ.get("Gemini_api")
     model_client = OpenAIChatCompletionClient(model="gemini-2.0-flash", api_key=gemini_api_key)
-    termination_condition = TextMentionTermination("TERMINATE")
+    interview_digest = await build_interview_digest(md_content, model_client)
+
+    # 各批次的 persona 由同一個 sink 依序寫入 persona_output.jsonl
+    persona_sink = PersonaSink(os.path.join(output_dir, "persona_output.jsonl"))
+    persona_sink.start()
+    # 各批次完成時立即寫入對話紀錄，不在記憶體中累積
+    output_csv = os.path.join(output_dir, conversation_log_path())
+    log_writer = ConversationLogWriter(output_csv, columns=LOG_COLUMNS)
+
+    done_chunks = 0
+    write_lock = asyncio.Lock()
+
+    async def run_chunk(idx, content):
+        nonlocal done_chunks
+        batch_messages, batch_personas = await process_chunk(content, idx * 1000, len(md_content), model_client, interview_digest, persona_sink, on_event)
+        # 對話紀錄的寫入在執行緒中進行，不阻塞 event loop；以 lock 讓各批次依序寫入
+        async with write_lock:
+            await asyncio.to_thread(log_writer.write_chunk, batch_messages)
+        done_chunks += 1
+        if on_event is not None:
+            on_event({"type": "progress", "done": done_chunks, "total": len(md_content)})
+        return batch_personas
 
     tasks = []
     
     # 處理批次資料
     for idx, content in enumerate(md_content):
-        tasks.append(process_chunk(content, idx * 1000, len(md_content), model_client, termination_condition, md_content))
+        tasks.append(run_chunk(idx, content))
 
-    results = await asyncio.gather(*tasks)
-    all_messages = []
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        await persona_sink.close()
+        log_writer.close()
     all_personas = []
-    for batch_messages, batch_personas in results:
-        all_messages.extend(batch_messages)
+    for batch_personas in results:
         all_personas.extend(batch_personas)
 
-    # 輸出 CSV 內容
-    output_csv = "all_conve_log.csv"
-    df_log = pd.DataFrame(all_messages)
-    df_log.to_csv(output_csv, index=False, encoding="utf-8-sig")
-
     # 儲存分析結果為 JSON 檔案
-    output_json = "all_personas.json"
+    output_json = os.path.join(output_dir, "all_personas.json")
     with open(output_json, 'w', encoding='utf-8') as f:
         json.dump(all_personas, f, ensure_ascii=False, indent=4)
 
     return output_csv, output_json
 
-def process_files(md_files):
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        md_paths = []
-        for i, file in enumerate(md_files):
-            md_path = os.path.join(tmpdirname, f"input_{i}.md")
-            if isinstance(file, str):
-                shutil.copy(file, md_path)
-            elif hasattr(file, "read"):
-                with open(md_path, "wb") as f:
-                    f.write(file.read())
-            else:
-                with open(md_path, "wb") as f:
-                    f.write(file)
-            md_paths.append(md_path)
-
-        current_dir = os.getcwd()
-        os.chdir(tmpdirname)
-        try:
-            output_csv, output_json = asyncio.run(process_all(md_paths))
-            dest_csv = os.path.join(current_dir, output_csv)
-            dest_json = os.path.join(current_dir, output_json)
-            shutil.copy(output_csv, dest_csv)
-            shutil.copy(output_json, dest_json)
-        finally:
-            os.chdir(current_dir)
-        return dest_csv, dest_json
-
 def save_personas_to_zip(personas, output_zip):
-    """將每個有效的 persona 儲存為單獨的 JSON 檔案，並壓縮成 zip 檔案"""
-    output_dir = "/tmp/personas"
-    os.makedirs(output_dir, exist_ok=True)
-
-    # 儲存每個 persona 為 JSON 檔案
-    for persona in personas:
-        if persona.get("description") != "..." and persona.get("motivation") != "...":
-            persona_id = persona.get("persona_id")
-            file_name = f"PERSONA-{persona_id}.json"
-            file_path = os.path.join(output_dir, file_name)
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(persona, f, ensure_ascii=False, indent=4)
-
-    # 壓縮所有檔案為 zip
-    with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(output_dir):
-            for file in files:
-                zipf.write(os.path.join(root, file), file)
-
-    print(f"所有 persona 檔案已壓縮為 {output_zip}")
+    """將每個有效的 persona 直接從記憶體寫入 zip 檔案，不產生暫存的 JSON 檔案"""
+    valid, _ = validate_personas(personas)
+    with PersonaZipWriter(output_zip) as writer:
+        written = writer.add(valid)
+    print(f"所有 persona 檔案已壓縮為 {output_zip}（共 {written} 個）")
     return output_zip
 
+async def process_all_and_zip(md_paths, output_dir=".", on_event=None):
+    """完成分析後將 persona 壓縮為 zip，回傳 (對話紀錄路徑, zip 路徑)"""
+    output_csv, output_json = await process_all(md_paths, output_dir, on_event)
+    with open(output_json, "r", encoding="utf-8") as f:
+        all_personas = json.load(f)
+    return output_csv, save_personas_to_zip(all_personas, os.path.join(output_dir, "personas.zip"))
+
 # Gradio 用戶介面處理
-def process_files_and_zip(md_files):
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        md_paths = []
-        for i, file in enumerate(md_files):
-            md_path = os.path.join(tmpdirname, f"input_{i}.md")
-            if isinstance(file, str):
-                shutil.copy(file, md_path)
-            elif hasattr(file, "read"):
-                with open(md_path, "wb") as f:
-                    f.write(file.read())
-            else:
-                with open(md_path, "wb") as f:
-                    f.write(file)
-            md_paths.append(md_path)
-
-        current_dir = os.getcwd()
-        os.chdir(tmpdirname)
-        try:
-            output_csv, output_json = asyncio.run(process_all(md_paths))
-
-            # 儲存 persona JSON 並壓縮為 zip 檔案
-            output_zip = "/tmp/personas.zip"
-            with open(output_json, 'r', encoding='utf-8') as f:
-                all_personas = json.load(f)
-            zip_file = save_personas_to_zip(all_personas, output_zip)
-
-            # 將生成的 CSV 和壓縮檔案移到原始目錄
-            dest_csv = os.path.join(current_dir, output_csv)
-            dest_json = os.path.join(current_dir, output_json)
-            shutil.copy(output_csv, dest_csv)
-            shutil.copy(zip_file, os.path.join(current_dir, "personas.zip"))
-            
-        finally:
-            os.chdir(current_dir)
-        return dest_csv, "personas.zip"
+def submit_job(md_files):
+    """建立背景 job 後立即返回 job id，進度與結果由 watch_job 串流取得"""
+    job_manager = get_job_manager()
+    job = job_manager.create()
+    md_paths = [upload_path(file, job["dir"], f"input_{i}.md") for i, file in enumerate(md_files or [])]
+    job_manager.start(job, process_all_and_zip, md_paths)
+    return job["id"], format_job_status(job)
 
 # Gradio 介面
 with gr.Blocks() as demo:
@@ -234,10 +228,16 @@ with gr.Blocks() as demo:
     with gr.Row():
         md_input = gr.File(label="上傳 MD 檔案", file_count="multiple")
     start_btn = gr.Button("開始")
+    job_id_input = gr.Textbox(label="job id（可輸入先前的 job id 查詢進度與結果）")
+    status_output = gr.Markdown()
+    persona_output = gr.Dataframe(label="已產生的 persona（即時更新）", headers=JOB_PREVIEW_COLUMNS, interactive=False)
     with gr.Row():
-        csv_output = gr.File(label="下載對話紀錄 CSV")
+        csv_output = gr.File(label=f"下載對話紀錄 {LOG_FORMAT.upper()}")
         zip_output = gr.File(label="下載 persona Zip")
-    start_btn.click(fn=process_files_and_zip, inputs=[md_input], outputs=[csv_output, zip_output])
+    start_btn.click(fn=submit_job, inputs=[md_input], outputs=[job_id_input, status_output]).then(
+        fn=watch_job, inputs=[job_id_input], outputs=[status_output, persona_output, csv_output, zip_output]
+    )
+    job_id_input.submit(fn=watch_job, inputs=[job_id_input], outputs=[status_output, persona_output, csv_output, zip_output])
 
 if __name__ == '__main__':
     demo.launch(share=True)
\ No newline at end of file
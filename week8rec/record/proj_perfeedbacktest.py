@@ -1,17 +1,33 @@
 import json
+import collections
 import os
+import sys
+import time
+import tempfile
+import zipfile
+import pandas as pd
 import gradio as gr
 from autogen_agentchat.agents import AssistantAgent
 from autogen_agentchat.conditions import TextMentionTermination
 from autogen_agentchat.teams import RoundRobinGroupChat
 from autogen_agentchat.messages import TextMessage
-from autogen_ext.models.openai import OpenAIChatCompletionClient
+from autogen_core.models import UserMessage
 from dotenv import load_dotenv
 import asyncio
 
 # 載入環境變數
 load_dotenv()
 
+# 共用模組放在專案根目錄的 persona_common；快取目錄以程式所在位置為準
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+os.environ.setdefault("PERSONA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".persona_cache"))
+
+from persona_common.llm import build_model_client
+
+# 評估使用的模型；共用的 build_model_client 另外提供回應快取、重試與退避、斷路器與每分鐘配額，
+# 批次評估同時送出大量請求時不會因 429 而變成錯誤列
+EVAL_MODEL = "gemini-2.0-flash"
+
 # 載入 persona
 def load_persona(persona_file):
     """載入 persona 資料"""
@@ -20,8 +36,11 @@ def load_persona(persona_file):
     return persona
 
 # 評估行銷文案並提供回饋
-async def evaluate_with_autoagent(persona, marketing_copy):
-    """根據 persona 評估行銷文案並提供回饋"""
+async def evaluate_with_autoagent(persona, marketing_copy, model_client=None):
+    """
+    根據 persona 評估行銷文案並提供回饋；可傳入共用的 model_client，不必每次重新建立。
+    未傳入時自行建立快取的 model client，評估結束後關閉。
+    """
     
     # 設定提示詞（繁體中文）
     prompt = f"""
@@ -38,8 +57,9 @@ async def evaluate_with_autoagent(persona, marketing_copy):
     """
     
     # 創建模型客戶端及代理
-    gemini_api_key = os.getenv("Gemini_api")
-    model_client = OpenAIChatCompletionClient(model="gemini-2.0-flash", api_key=gemini_api_key)
+    own_client = model_client is None
+    if own_client:
+        model_client = build_model_client(EVAL_MODEL)
     termination_condition = TextMentionTermination("TERMINATE")
 
     assistant = AssistantAgent("persona_assistant", model_client)
@@ -47,15 +67,131 @@ async def evaluate_with_autoagent(persona, marketing_copy):
 
     # 執行代理並取得回應
     messages = []
-    async for event in group_chat.run_stream(task=prompt):
-        if isinstance(event, TextMessage):
-            messages.append({
-                "content": event.content,
-                "source": event.source
-            })
+    try:
+        async for event in group_chat.run_stream(task=prompt):
+            if isinstance(event, TextMessage):
+                messages.append({
+                    "content": event.content,
+                    "source": event.source
+                })
+    finally:
+        if own_client:
+            await model_client.close()
 
     return messages
 
+# 批次評估：N 個 persona × M 篇文案，共用一個 model client，以 semaphore 限制同時進行的評估數
+EVAL_MAX_CONCURRENCY = int(os.environ.get("EVAL_MAX_CONCURRENCY", "8"))
+# 在文字框中以單獨一行的 --- 分隔多篇文案
+COPY_SEPARATOR = "---"
+EVAL_COLUMNS = ["persona", "copy", "score", "reasons_for", "reasons_against", "prompt_tokens", "completion_tokens", "error"]
+
+def load_personas(path):
+    """
+    載入 persona 清單，回傳 [(名稱, persona)]。
+    支援 personas.zip（每個 PERSONA-*.json 一個 persona）以及單一 persona 或 persona 陣列的 JSON 檔。
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zipf:
+            names = sorted(name for name in zipf.namelist() if name.endswith(".json"))
+            loaded = [(os.path.splitext(os.path.basename(name))[0], json.loads(zipf.read(name))) for name in names]
+    else:
+        data = load_persona(path)
+        personas = data if isinstance(data, list) else [data]
+        loaded = [(f"PERSONA-{persona.get('persona_id') or i}", persona) for i, persona in enumerate(personas, start=1)]
+    # 名稱重複時（例如各批次的 persona_id 都從 1 開始）加上清單中的序號，分數矩陣的列名稱才不會重複
+    counts = collections.Counter(name for name, _ in loaded)
+    return [
+        (name if counts[name] == 1 else f"{name}-{i}", persona)
+        for i, (name, persona) in enumerate(loaded, start=1)
+    ]
+
+def split_copies(text):
+    """將文字框內以 --- 分隔的多篇文案拆開，回傳 [(名稱, 文案)]"""
+    copies, current = [], []
+    for line in text.splitlines():
+        if line.strip() == COPY_SEPARATOR:
+            copies.append("\n".join(current).strip())
+            current = []
+        else:
+            current.append(line)
+    copies.append("\n".join(current).strip())
+    return [(f"copy_{i}", copy) for i, copy in enumerate((c for c in copies if c), start=1)]
+
+def build_evaluation_prompt(persona, marketing_copy):
+    """批次評估的提示詞，要求模型只輸出 JSON，方便整理成分數矩陣"""
+    return (
+        "你正在扮演一個 persona，這個 persona 的描述如下：\n"
+        f"{json.dumps(persona, ensure_ascii=False)}\n\n"
+        f"以下是課程的行銷文案：\n\"{marketing_copy}\"\n\n"
+        "請以這個 persona 的角度評估，並只輸出下列格式的 JSON，不要包含其他內容：\n"
+        '{"score": 購買意願（1-10 的整數，數字越大代表越有意願購買）, '
+        '"reasons_for": "想購買的原因", "reasons_against": "沒有被打動的原因"}'
+    )
+
+def parse_evaluation(text):
+    """從模型回覆中取出評估 JSON，分數限制在 1-10；無法解析時回傳 None"""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        result = json.loads(text[start:end + 1])
+        score = min(max(int(float(result["score"])), 1), 10)
+    except (ValueError, KeyError, TypeError):
+        return None
+    return {
+        "score": score,
+        "reasons_for": str(result.get("reasons_for", "")).strip(),
+        "reasons_against": str(result.get("reasons_against", "")).strip(),
+    }
+
+async def evaluate_pair(model_client, slots, persona_name, persona, copy_name, marketing_copy):
+    """評估一組 persona × 文案，失敗時在 error 欄位記錄原因，不中斷整批評估"""
+    row = {"persona": persona_name, "copy": copy_name}
+    async with slots:
+        try:
+            result = await model_client.create([UserMessage(content=build_evaluation_prompt(persona, marketing_copy), source="user")])
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+            return row
+    row["prompt_tokens"] = result.usage.prompt_tokens
+    row["completion_tokens"] = result.usage.completion_tokens
+    parsed = parse_evaluation(result.content if isinstance(result.content, str) else "")
+    if parsed is None:
+        row["error"] = "無法解析模型回覆"
+        row["reasons_for"] = result.content
+    else:
+        row.update(parsed)
+    return row
+
+async def evaluate_batch(personas, copies, model_client=None, max_concurrency=EVAL_MAX_CONCURRENCY):
+    """
+    以共用的 model client 同時評估 personas × copies 的所有組合，同時進行的請求數不超過 max_concurrency。
+    personas、copies 皆為 [(名稱, 內容)]，回傳每組一列的 DataFrame。
+    """
+    own_client = model_client is None
+    if own_client:
+        model_client = build_model_client(EVAL_MODEL)
+    slots = asyncio.Semaphore(max_concurrency)
+    started = time.perf_counter()
+    try:
+        rows = await asyncio.gather(*(
+            evaluate_pair(model_client, slots, persona_name, persona, copy_name, marketing_copy)
+            for persona_name, persona in personas
+            for copy_name, marketing_copy in copies
+        ))
+    finally:
+        if own_client:
+            await model_client.close()
+    print(f"完成 {len(rows)} 組評估，耗時 {time.perf_counter() - started:.1f} 秒")
+    return pd.DataFrame(rows, columns=EVAL_COLUMNS)
+
+def score_matrix(results):
+    """將評估結果整理成 persona × 文案的購買意願分數矩陣，最後一列為各文案的平均分數"""
+    matrix = results.pivot(index="persona", columns="copy", values="score")
+    matrix.loc["平均"] = matrix.mean()
+    return matrix
+
 # 處理評估過程
 def process_evaluation(persona_file, marketing_copy):
     """載入 persona 並評估行銷文案"""
@@ -72,21 +208,46 @@ def gradio_interface(persona_file, marketing_copy):
     feedback = process_evaluation(persona_file.name, marketing_copy)
     return feedback
 
+async def batch_interface(personas_file, copies_text, max_concurrency):
+    """批次評估的 Gradio 函數：回傳分數矩陣，以及矩陣與完整評估結果的 CSV"""
+    personas = load_personas(personas_file if isinstance(personas_file, str) else personas_file.name)
+    copies = split_copies(copies_text)
+    results = await evaluate_batch(personas, copies, max_concurrency=int(max_concurrency))
+    matrix = score_matrix(results)
+    output_dir = tempfile.mkdtemp(prefix="persona_eval_")
+    results_csv = os.path.join(output_dir, "evaluation_results.csv")
+    matrix_csv = os.path.join(output_dir, "evaluation_matrix.csv")
+    results.to_csv(results_csv, index=False, encoding="utf-8-sig")
+    matrix.to_csv(matrix_csv, encoding="utf-8-sig")
+    return matrix.reset_index(), [matrix_csv, results_csv]
+
 # 設置 Gradio 界面
 with gr.Blocks() as demo:
     gr.Markdown("# Persona 行銷文案評估系統")
-    
-    # 上傳檔案區
-    with gr.Row():
-        persona_file = gr.File(label="上傳 Persona JSON 檔案", file_count="single")
-        marketing_copy = gr.Textbox(label="輸入行銷文案", placeholder="請輸入或粘貼行銷文案", lines=10)
-    
-    start_btn = gr.Button("開始評估")
-    
-    # 回饋顯示區
-    output_feedback = gr.Textbox(label="回饋結果", lines=10, interactive=False)
 
-    start_btn.click(fn=gradio_interface, inputs=[persona_file, marketing_copy], outputs=[output_feedback])
+    with gr.Tab("單篇評估"):
+        # 上傳檔案區
+        with gr.Row():
+            persona_file = gr.File(label="上傳 Persona JSON 檔案", file_count="single")
+            marketing_copy = gr.Textbox(label="輸入行銷文案", placeholder="請輸入或粘貼行銷文案", lines=10)
+
+        start_btn = gr.Button("開始評估")
+
+        # 回饋顯示區
+        output_feedback = gr.Textbox(label="回饋結果", lines=10, interactive=False)
+
+        start_btn.click(fn=gradio_interface, inputs=[persona_file, marketing_copy], outputs=[output_feedback])
+
+    with gr.Tab("批次評估"):
+        with gr.Row():
+            personas_file = gr.File(label="上傳 personas.zip 或 Persona JSON 檔案", file_count="single")
+            copies_text = gr.Textbox(label="輸入多篇行銷文案（以單獨一行的 --- 分隔）", lines=10)
+        concurrency_input = gr.Slider(1, 32, value=EVAL_MAX_CONCURRENCY, step=1, label="同時評估數")
+        batch_btn = gr.Button("開始批次評估")
+        matrix_output = gr.Dataframe(label="購買意願分數矩陣（persona × 文案）", interactive=False)
+        batch_files = gr.File(label="下載評估結果 CSV", file_count="multiple")
+
+        batch_btn.click(fn=batch_interface, inputs=[personas_file, copies_text, concurrency_input], outputs=[matrix_output, batch_files])
 
 if __name__ == '__main__':
     demo.launch(share=True)